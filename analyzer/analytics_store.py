@@ -0,0 +1,248 @@
+"""Columnar copy of the stocks and daystocks hypertables, for offline analysis.
+
+Each month of a table is exported from Postgres into Parquet files holding
+the rows of a bucket of companies, partitioned like
+
+  STORE_PATH/<table>/year=<year>/bucket=<cid % NB_BUCKETS>/<year>-<month>.parquet
+
+The rows are sorted by cid and date, so that the statistics of the row groups
+skip the other companies of the bucket. The watermark of the store is the
+ingest time of the last file_done exported, kept in tags: a refresh only
+exports again the months of the files ingested since. The companies are
+copied whole.
+
+Dates are the naive timestamps of the database time zone, like the frames of
+the ingest. Reads push the company and date filters down to the partitions
+and the row groups, and memory map the files.
+
+  python3 analytics_store.py
+"""
+
+from datetime import datetime
+import io
+import os
+from typing import Optional
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from constant import STORE_PATH
+import timescaledb_model as tsdb
+
+NB_BUCKETS = 16
+ROW_GROUP_SIZE = 64 * 1024
+WATERMARK_TAG = "analytics_store_done_at"
+TABLE_TYPES = {
+    "stocks": {
+        "date": pa.timestamp("us"),
+        "cid": pa.int16(),
+        "value": pa.float32(),
+        "volume": pa.int64(),
+    },
+    "daystocks": {
+        "date": pa.timestamp("us"),
+        "cid": pa.int16(),
+        "open": pa.float32(),
+        "close": pa.float32(),
+        "high": pa.float32(),
+        "low": pa.float32(),
+        "volume": pa.int64(),
+        "mean": pa.float32(),
+        "std": pa.float32(),
+        "nb": pa.int32(),
+    },
+}
+
+
+def copy_query(db: tsdb.TimescaleStockMarketModel, query: str, types: dict) -> pa.Table:
+    """Rows of ``query`` through COPY, as an Arrow table of ``types``"""
+    buffer = io.BytesIO()
+    with db.connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV", buffer)
+    if buffer.tell() == 0:
+        return pa.table({c: pa.array([], t) for c, t in types.items()})
+    buffer.seek(0)
+    return pv.read_csv(
+        buffer,
+        read_options=pv.ReadOptions(column_names=list(types)),
+        convert_options=pv.ConvertOptions(
+            column_types=types,
+            strings_can_be_null=True,
+            true_values=["t"],
+            false_values=["f"],
+        ),
+    )
+
+
+def get_month_dir(store_path: str, table: str, month: pd.Period, bucket: int) -> str:
+    return os.path.join(store_path, table, f"year={month.year}", f"bucket={bucket}")
+
+
+def write_parquet(table: pa.Table, path: str, **kwargs):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table, path + ".tmp", compression="zstd", **kwargs)
+    os.replace(path + ".tmp", path)
+
+
+def export_month(
+    db: tsdb.TimescaleStockMarketModel,
+    table: str,
+    month: pd.Period,
+    store_path: str = STORE_PATH,
+) -> int:
+    """Export a month of ``table``, replacing its files, returns its rows"""
+    types = TABLE_TYPES[table]
+    columns = ", ".join("date::timestamp" if c == "date" else c for c in types)
+    start, end = month.start_time, (month + 1).start_time
+    rows = copy_query(
+        db,
+        f"SELECT {columns} FROM {table}"
+        f" WHERE date >= '{start}' AND date < '{end}' ORDER BY cid, date",
+        types,
+    )
+    buckets = pc.remainder(rows["cid"], NB_BUCKETS)  # type: ignore
+    for bucket in range(NB_BUCKETS):
+        path = os.path.join(
+            get_month_dir(store_path, table, month, bucket), f"{month}.parquet"
+        )
+        bucket_rows = rows.filter(pc.equal(buckets, bucket))
+        if len(bucket_rows) > 0:
+            write_parquet(bucket_rows, path, row_group_size=ROW_GROUP_SIZE)
+        elif os.path.exists(path):
+            os.remove(path)
+    return len(rows)
+
+
+def get_watermark(
+    db: tsdb.TimescaleStockMarketModel, store_path: str = STORE_PATH
+) -> Optional[datetime]:
+    """Ingest time of the last file exported, None for an empty store"""
+    if not os.path.exists(os.path.join(store_path, "companies.parquet")):
+        return None
+    rows = db.raw_query("SELECT value FROM tags WHERE name = %s", (WATERMARK_TAG,))
+    return datetime.fromisoformat(rows[0][0]) if len(rows) > 0 else None
+
+
+def get_new_months(
+    db: tsdb.TimescaleStockMarketModel,
+    watermark: Optional[datetime],
+    done_at: datetime,
+) -> tuple[list[pd.Period], int]:
+    """Months of the files ingested after ``watermark`` until ``done_at``, and
+    the number of these files"""
+    rows = db.raw_query(
+        r"""SELECT left(substring(name FROM '\d{4}-\d{2}-\d{2}'), 7), count(*)
+            FROM file_done
+            WHERE done_at > coalesce(%s, '-infinity'::timestamptz) AND done_at <= %s
+            GROUP BY 1""",
+        (watermark, done_at),
+    )
+    months = sorted(pd.Period(month, "M") for month, _ in rows if month is not None)
+    return months, sum(count for _, count in rows)
+
+
+def update_store(db: tsdb.TimescaleStockMarketModel, store_path: str = STORE_PATH):
+    """Export the months of the files ingested since the last update"""
+    watermark = get_watermark(db, store_path)
+    done_at = db.raw_query("SELECT max(done_at) FROM file_done")[0][0]
+    if done_at is None or (watermark is not None and done_at <= watermark):
+        db.commit()
+        print("Analytics store: up to date")
+        return
+    months, nb_files = get_new_months(db, watermark, done_at)
+    db.commit()
+    nb_rows = 0
+    for month in months:
+        for table in TABLE_TYPES:
+            nb_rows += export_month(db, table, month, store_path)
+    companies = copy_query(
+        db,
+        "SELECT id, name, mid, symbol, isin, pea FROM companies ORDER BY id",
+        {
+            "id": pa.int16(),
+            "name": pa.string(),
+            "mid": pa.int16(),
+            "symbol": pa.string(),
+            "isin": pa.string(),
+            "pea": pa.bool_(),
+        },
+    )
+    db.commit()
+    write_parquet(companies, os.path.join(store_path, "companies.parquet"))
+    # the watermark last, an interrupted update exports its months again
+    db.execute(
+        """INSERT INTO tags (name, value) VALUES (%s, %s)
+           ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value""",
+        (WATERMARK_TAG, done_at.isoformat()),
+        commit=True,
+    )
+    print(
+        f"Analytics store: {nb_files} new files,"
+        f" {len(months)} months exported, {nb_rows} rows"
+    )
+
+
+def read_store(
+    table: str,
+    cids: Optional[list[int]] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    columns: Optional[list[str]] = None,
+    store_path: str = STORE_PATH,
+) -> pd.DataFrame:
+    """Rows of ``table`` for the companies ``cids``, from ``start`` to before
+    ``end``, all of them by default, ordered by cid and date within a file"""
+    path = os.path.join(store_path, table)
+    if not os.path.isdir(path):
+        return pd.DataFrame(columns=columns or list(TABLE_TYPES[table]))
+    filters = []
+    if cids is not None:
+        filters.append(("bucket", "in", sorted({c % NB_BUCKETS for c in cids})))
+        filters.append(("cid", "in", list(cids)))
+    if start is not None:
+        filters.append(("year", ">=", start.year))
+        filters.append(("date", ">=", pd.Timestamp(start)))
+    if end is not None:
+        filters.append(("year", "<=", end.year))
+        filters.append(("date", "<", pd.Timestamp(end)))
+    rows = pq.read_table(
+        path,
+        columns=columns or list(TABLE_TYPES[table]),
+        filters=filters or None,
+        partitioning="hive",
+        memory_map=True,
+    )
+    return rows.to_pandas()
+
+
+def read_stocks(
+    cids: Optional[list[int]] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    columns: Optional[list[str]] = None,
+    store_path: str = STORE_PATH,
+) -> pd.DataFrame:
+    return read_store("stocks", cids, start, end, columns, store_path)
+
+
+def read_daystocks(
+    cids: Optional[list[int]] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    columns: Optional[list[str]] = None,
+    store_path: str = STORE_PATH,
+) -> pd.DataFrame:
+    return read_store("daystocks", cids, start, end, columns, store_path)
+
+
+def read_companies(store_path: str = STORE_PATH) -> pd.DataFrame:
+    return pq.read_table(
+        os.path.join(store_path, "companies.parquet"), memory_map=True
+    ).to_pandas()
+
+
+if __name__ == "__main__":
+    from analyze import init_db
+
+    update_store(init_db())
@@ -1,162 +1,432 @@
 import pandas as pd
 import multiprocessing
 import concurrent.futures
-from constant import IS_DOCKER
+import os
+import sys
+from constant import (
+    ANALYTICS_STORE,
+    DATA_PATH,
+    DB_HOST,
+    DB_PORT,
+    DECODE_PROCESSES,
+    MEMORY_BUDGET,
+    PIPELINE_DEPTH,
+    PROFILE,
+    QUARANTINE_BACKOFF,
+    QUARANTINE_MAX_ATTEMPTS,
+    QUARANTINE_MAX_BACKOFF,
+    SNAPSHOT_CACHE,
+    SNAPSHOT_DEDUP,
+    STOCKS_COMPRESSION,
+    WATCH_INTERVAL,
+    WATCH_SETTLE,
+)
 import timescaledb_model as tsdb
-import numpy as np
-from utils import get_files_infos_df, timer_decorator, multi_read_df_from_paths
-from companies import update_companies
+import metrics
+import profiling
+from utils import get_error_reasons, timer_decorator, read_files_df
+from bars import df_to_code_bars, relabel_cids
+from manifest import NewFiles, get_manifest_files_infos_df, restat
+from companies import df_to_companies, get_market_default_mids
+from directory_watch import get_watch
+from symbol_registry import SymbolRegistry
+from shared_decode import process_read_files_df, shutdown_decode_executor
+from snapshot_cache import read_snapshots, update_cache
+from analytics_store import update_store
+from pipeline import run_pipeline, StageError
+from scheduler import (
+    get_date_costs,
+    get_max_rss,
+    get_memory_budget,
+    log_utilization,
+    make_work_queue,
+    plan_date_groups,
+    plan_workers,
+)
 from datetime import date
-from functools import partial
-from typing import Optional
+from typing import Collection, Optional
 import time
 
 
 def init_db(
     setup=False, clean_setup=False, show_log_path=False
 ) -> tsdb.TimescaleStockMarketModel:
-    return (
-        tsdb.TimescaleStockMarketModel(
-            "bourse",
-            "ricou",
-            "db",
-            "monmdp",
-            setup=setup,
-            clean_setup=clean_setup,
-            show_log_path=show_log_path,
-        )
-        if IS_DOCKER
-        else tsdb.TimescaleStockMarketModel(
-            "bourse",
-            "ricou",
-            "localhost",
-            "monmdp",
-            setup=setup,
-            clean_setup=clean_setup,
-            show_log_path=show_log_path,
-        )
+    return tsdb.TimescaleStockMarketModel(
+        "bourse",
+        "ricou",
+        DB_HOST,
+        "monmdp",
+        port=DB_PORT,
+        setup=setup,
+        clean_setup=clean_setup,
+        show_log_path=show_log_path,
     )
 
 
-def dfs_to_stocks2(df: pd.DataFrame) -> pd.DataFrame:
-    df_stocks = df.drop(columns=["name"])
-    df_stocks["volume"] = df_stocks["volume"].apply(lambda x: np.nan if x < 0 else x)
-    df_stocks = df_stocks.groupby(["symbol", pd.Grouper(level=0, freq="1T")]).mean()
-    df_stocks["volume"] = df_stocks["volume"].ffill()
-    df_stocks = df_stocks[(df_stocks["volume"] > 0) | (df_stocks["last"] > 0)]
-    df_stocks = df_stocks.reset_index(level="symbol")
-    return df_stocks
+def get_file_not_dones_df(
+    db: tsdb.TimescaleStockMarketModel, files_infos_df: pd.DataFrame
+) -> pd.DataFrame:
+    pending_names = db.get_pending_files(files_infos_df["name"])
+    return files_infos_df[files_infos_df["name"].isin(pending_names)]
 
 
-def update_daystocks(
-    db: tsdb.TimescaleStockMarketModel, df_stocks: pd.DataFrame, commit: bool = False
-):
-    df_stocks.reset_index(inplace=True)
-    df_stocks["date"] = df_stocks["date"].dt.date
-    df_daystocks = df_stocks.groupby(["date", "cid"]).agg(
-        open=("value", "first"),
-        close=("value", "last"),
-        high=("value", "max"),
-        low=("value", "min"),
-        volume=("volume", "last"),
-        mean=("value", "mean"),
-        std=("value", "std"),
-    )
-    df_daystocks = df_daystocks.fillna(0)
-    db.df_write(df_daystocks, "daystocks", commit=commit)
+def get_partial_days(files_infos_df: pd.DataFrame, files_df: pd.DataFrame) -> set:
+    """Days of ``files_df`` having other files in ``files_infos_df``
 
+    These files are written or quarantined already, the files of ``files_df``
+    complete their days instead of replacing them.
+    """
+    others_df = files_infos_df[~files_infos_df["name"].isin(files_df["name"])]
+    return set(files_df["date"]) & set(others_df["date"])
 
-def update_stocks2(
-    db: tsdb.TimescaleStockMarketModel,
-    df: pd.DataFrame,
-    symbol_to_companies: dict,
-    commit: bool = False,
-) -> pd.DataFrame:
-    df_stocks = dfs_to_stocks2(df)
-    df_stocks["cid"] = df_stocks["symbol"].map(symbol_to_companies)
-    df_stocks.rename(columns={"last": "value"}, inplace=True)
-    df_stocks.drop(columns=["symbol"], inplace=True)
-    df_stocks["cid"] = df_stocks["cid"].astype(np.int16)
-    df_stocks["value"] = df_stocks["value"].astype(np.float32)
-    df_stocks["volume"] = df_stocks["volume"].astype(np.int64)
-    db.df_write(df_stocks, "stocks", commit=commit)
-    return df_stocks
 
-
-def get_file_not_dones_df(
-    db: tsdb.TimescaleStockMarketModel, files_infos_df: pd.DataFrame
-) -> pd.DataFrame:
-    files_names = [i[0] for i in db.raw_query("SELECT * FROM file_done")]
-    return files_infos_df[~files_infos_df["name"].isin(files_names)]
+# state of a worker process, set once by init_worker
+worker_state: dict = {}
 
 
-def update_file_done(
-    db: tsdb.TimescaleStockMarketModel,
+def init_worker(
     files_infos_df: pd.DataFrame,
-    commit: bool = False,
+    symbol_to_companies: dict,
+    work_queue: multiprocessing.Queue,
+    nb_date_group: int,
+    num_thread: int,
+    num_decode_process: int = 0,
+    partial_days: Collection[date] = (),
 ):
-    files_dones = files_infos_df["name"]
-    db.df_write(files_dones, "file_done", index=False, commit=commit)
+    """ProcessPoolExecutor initializer: one model and one catalog per process.
+
+    With the fork start method the arguments are inherited, not pickled, and
+    the catalog is indexed by date once instead of being filtered per group.
+    """
+    worker_state["files_by_date"] = {
+        d: files_df for d, files_df in files_infos_df.groupby("date")
+    }
+    worker_state["registry"] = SymbolRegistry(symbol_to_companies)
+    worker_state["work_queue"] = work_queue
+    worker_state["nb_date_group"] = nb_date_group
+    worker_state["num_thread"] = num_thread
+    worker_state["num_decode_process"] = num_decode_process
+    worker_state["partial_days"] = partial_days
+    worker_state["db"] = init_db()
+    worker_state["db"].create_staging_tables()
+    metrics.set_labels(worker=str(os.getpid()))
+
+
+def get_worker_db() -> tsdb.TimescaleStockMarketModel:
+    """Return the model of this process, reconnecting if the connection died"""
+    db = worker_state.get("db")
+    if db is None or db.connection.closed:
+        db = worker_state["db"] = init_db()
+        db.create_staging_tables()
+    return db
 
 
-def process_date_group2(
+def get_companies_mids(db: tsdb.TimescaleStockMarketModel) -> dict:
+    """Market ids arguments of ``companies.df_to_companies``"""
+    return {
+        "prefix_to_market_id": db.prefix_to_market_id,
+        "market_default_mids": get_market_default_mids(db),
+        "default_mid": db.prefix_to_market_id["1rP"],
+    }
+
+
+def read_date_group(
     date_group: list[date],
-    index: int,
-    symbol_to_companies: dict,
-    files_infos_df: pd.DataFrame,
-    nb_date_group: int,
+    files_by_date: dict,
     num_thread: int,
+    num_decode_process: int = 0,
+    check_files: bool = False,
+) -> tuple[pd.DataFrame, pd.DataFrame, dict]:
+    """Read the files of a date group, with the reason of the unreadable ones
+
+    The fast readers fail on the first bad file, the group is then read again
+    file by file, checking each of them, as with ``check_files``.
+    """
+    date_group_files_df = pd.concat(
+        [files_by_date[d] for d in date_group if d in files_by_date]
+    )
+    if not check_files:
+        try:
+            if SNAPSHOT_CACHE:
+                df = read_snapshots(date_group_files_df, num_thread)
+            elif num_decode_process > 0:
+                df = process_read_files_df(date_group_files_df, num_decode_process)
+            else:
+                df = read_files_df(date_group_files_df, num_thread=num_thread)
+            return date_group_files_df, df, {}
+        except Exception as e:
+            print(date_group, "Read error, checking the files: ", e)
+            metrics.inc("analyzer_retries_total", len(date_group), stage="read")
+    read_errors: dict = {}
+    df = read_files_df(date_group_files_df, num_thread, errors=read_errors)
+    return date_group_files_df, df, read_errors
+
+
+def transform_date_group(
+    df: pd.DataFrame,
+    registry: SymbolRegistry,
+    companies_mids: dict,
+    dedup_stats: Optional[dict] = None,
+) -> tuple[pd.Index, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Bars of the date group and the companies of its unknown symbols
+
+    The bars are labelled with the codes of the symbols, returned first, as
+    the new companies have no id yet. The companies see every snapshot, the
+    bars are resampled from the changes only when SNAPSHOT_DEDUP is set,
+    counted in ``dedup_stats``.
+    """
+    symbols = df["symbol"].cat.categories
+    if len(registry.get_unknown_symbols(symbols)) == 0:
+        df_companies = pd.DataFrame()
+    else:
+        df_companies = df_to_companies(df, **companies_mids)
+    return symbols, df_companies, *df_to_code_bars(df, SNAPSHOT_DEDUP, dedup_stats)
+
+
+def write_date_group(
+    db: tsdb.TimescaleStockMarketModel,
+    registry: SymbolRegistry,
+    date_group_files_df: pd.DataFrame,
+    read_errors: dict,
+    symbols: pd.Index,
+    df_companies: pd.DataFrame,
+    df_stocks: pd.DataFrame,
+    df_daystocks: pd.DataFrame,
+    partial_days: Collection[date] = (),
 ):
-    start_time = time.time()
-    date_group_repr = ", ".join([d.isoformat() for d in date_group])
-    index_repr = f", index:  {index} / {nb_date_group}"
-    print("Processing: ", date_group_repr, index_repr)
-    db = init_db()
-    date_group_files_df = files_infos_df[files_infos_df["date"].isin(date_group)]
-    stock_paths = list(date_group_files_df["path"])
-    df = multi_read_df_from_paths(stock_paths, num_thread=num_thread)
-    try:
-        df_stocks = update_stocks2(db, df, symbol_to_companies)
-        update_daystocks(db, df_stocks)
-        update_file_done(db, date_group_files_df)
+    """Register the new symbols, then stage the rows of a date group and
+    merge them in one transaction
+
+    The unreadable files are quarantined in the same transaction, the files
+    written are released from quarantine. The daily bars of the
+    ``partial_days``, whose files are only a part of the day, complete the
+    existing days, the others replace them.
+    """
+    if len(df_companies) > 0:
+        inserted = registry.register(db, df_companies)
+        if inserted > 0:
+            print(f"Registered {inserted} new companies")
+    df_stocks, df_daystocks = relabel_cids(
+        df_stocks, df_daystocks, registry.get_cids_by_code(symbols)
+    )
+    if len(read_errors) > 0:
+        is_bad = date_group_files_df["name"].isin(list(read_errors))
+        db.quarantine_files(date_group_files_df[is_bad], "read", read_errors)
+        metrics.count_quarantined("read", date_group_files_df[is_bad])
+        date_group_files_df = date_group_files_df[~is_bad]
+    dates = df_daystocks.index.get_level_values("date")
+    is_partial = dates.isin(pd.to_datetime(list(partial_days)))
+    with metrics.timed("copy"):
+        db.stage_write(df_stocks, "stocks")
+        db.stage_write(df_daystocks[~is_partial], "daystocks")
+        db.stage_write(date_group_files_df["name"], "file_done", index=False)
+    metrics.count_rows("copy", len(df_stocks) + len(df_daystocks))
+    with metrics.timed("commit"):
+        db.merge_staged("stocks")
+        db.merge_staged("daystocks")
+        if is_partial.any():
+            db.execute("TRUNCATE stage_daystocks")
+            db.stage_write(df_daystocks[is_partial], "daystocks")
+            db.accumulate_staged_daystocks()
+        db.merge_staged("file_done")
+        db.release_quarantined()
         db.commit()
-    except Exception as e:
-        db.connection.rollback()
-        df = pd.DataFrame({"date": date_group})
-        db.df_write(df, "error_dates", index=False, commit=True)
-        print(date_group, "Error: ", e)
-    else:
+
+
+def process_date_groups(depth: int = PIPELINE_DEPTH) -> dict:
+    """Process date groups through a read -> transform -> write pipeline.
+
+    The groups are pulled from the work queue until it runs dry. The files of
+    the next group are read and resampled while the current group is being
+    written, ``depth`` bounds the number of groups in flight. Runs in a
+    worker process set up by ``init_worker`` and returns its statistics.
+
+    Groups which fail are processed again day by day, checking every file:
+    unreadable files are quarantined and the others written. The files of a
+    day which still fails are all quarantined.
+    """
+    db = get_worker_db()
+    registry = worker_state["registry"]
+    companies_mids = get_companies_mids(db)
+    nb_date_group = worker_state["nb_date_group"]
+    work_queue = worker_state["work_queue"]
+    stats = {"pid": os.getpid(), "groups": 0, "cost": 0, "start": time.time()}
+    start_times = {}
+    failed_items = []
+    check_files = False
+
+    def group_repr(item):
+        index, date_group, _ = item
+        date_group_repr = ", ".join([d.isoformat() for d in date_group])
+        return f"{date_group_repr}, index:  {index} / {nb_date_group}"
+
+    def read(item):
+        start_times[group_repr(item)] = time.time()
+        print("Processing: ", group_repr(item))
+        with metrics.timed("read"):
+            date_group_files_df, df, read_errors = read_date_group(
+                item[1],
+                worker_state["files_by_date"],
+                worker_state["num_thread"],
+                worker_state["num_decode_process"],
+                check_files=check_files,
+            )
+        is_read = ~date_group_files_df["name"].isin(list(read_errors))
+        metrics.count_files("read", date_group_files_df[is_read])
+        metrics.count_rows("read", df["market"].value_counts())
+        return date_group_files_df, df, read_errors
+
+    def transform(_, value):
+        date_group_files_df, df, read_errors = value
+        dedup_stats: dict = {}
+        with metrics.timed("resample"):
+            symbols, df_companies, df_stocks, df_daystocks = transform_date_group(
+                df, registry, companies_mids, dedup_stats
+            )
+        metrics.count_rows("resample", len(df_stocks) + len(df_daystocks))
+        metrics.count_dedup(dedup_stats)
+        for kind, count in dedup_stats.items():
+            stats[kind] = stats.get(kind, 0) + count
+        return (
+            date_group_files_df,
+            read_errors,
+            symbols,
+            df_companies,
+            df_stocks,
+            df_daystocks,
+        )
+
+    def write(item, value):
+        write_date_group(
+            db, registry, *value, partial_days=worker_state["partial_days"]
+        )
+        metrics.dump()
+        stats["groups"] += 1
+        stats["cost"] += item[2]
         print(
             "Done for ",
-            date_group_repr,
-            index_repr,
+            group_repr(item),
             ", time: ",
-            time.time() - start_time,
+            time.time() - start_times.pop(group_repr(item)),
             "s",
         )
 
+    def on_error(item, error: StageError):
+        db.connection.rollback()
+        start_times.pop(group_repr(item), None)
+        print(item[1], f"Error in {error.stage}: ", error.exception)
+        index, date_group, cost = item
+        if not check_files:
+            failed_items.extend((index, [d], cost // len(date_group)) for d in date_group)
+            metrics.inc("analyzer_retries_total", len(date_group), stage=error.stage)
+            return
+        files_df = worker_state["files_by_date"].get(date_group[0])
+        if files_df is not None:
+            reasons = get_error_reasons(error.exception)
+            db.quarantine_files(files_df, error.stage, reasons)
+            db.commit()
+            metrics.count_quarantined(error.stage, files_df)
+        metrics.dump()
+
+    read = profiling.profiled(read, "read")
+    transform = profiling.profiled(transform, "transform")
+    write = profiling.profiled(write, "write", last=True)
+    on_error = profiling.profiled(on_error, "on_error", last=True)
+    run_pipeline(
+        iter(work_queue.get, None), read, transform, write, on_error, depth=depth
+    )
+    if len(failed_items) > 0:
+        check_files = True
+        run_pipeline(iter(failed_items), read, transform, write, on_error, depth=depth)
+    shutdown_decode_executor()
+    stats["end"] = time.time()
+    stats["max_rss"] = get_max_rss()
+    stats["companies"] = registry.nb_registered
+    return stats
+
 
-def update_companies_errors(
+def log_dedup(workers_stats: list[dict]):
+    """Print the ticks cut by the dedup of the workers"""
+    totals = {
+        kind: sum(s.get(kind, 0) for s in workers_stats)
+        for kind in ("ticks", "repeats", "copies")
+    }
+    if totals["ticks"] == 0:
+        return
+    print(
+        f"Dedup: {totals['repeats'] + totals['copies']} of {totals['ticks']} ticks cut"
+        f" ({totals['repeats']} unchanged, {totals['copies']} copies of another"
+        f" market) before resampling"
+    )
+
+
+def ingest_files(
     db: tsdb.TimescaleStockMarketModel,
-    error_dates: list,
-    files_infos_df: pd.DataFrame,
+    files_df: pd.DataFrame,
     num_cpus: int,
-    num_thread: int,
-    existing_symbols: list[str],
+    num_threads: int,
+    num_decode_process: int = DECODE_PROCESSES,
+    partial_days: Collection[date] = (),
 ):
-    error_dates = [e[0].date() for e in error_dates]
-    files_infos_df = files_infos_df[files_infos_df["date"].isin(error_dates)]
-    update_companies(
-        db,
-        files_infos_df,
-        num_cpus,
-        num_thread,
-        keep_first_last=False,
-        existing_symbols=existing_symbols,
+    """Ingest the files of ``files_df`` with a pool of workers
+
+    The files of the ``partial_days`` complete the days already written, the
+    others are whole days to write again. Returns the statistics of the
+    workers.
+    """
+    # the workers register the companies they discover
+    symbol_to_companies = dict(db.raw_query("SELECT symbol, id FROM companies"))
+    date_costs = get_date_costs(files_df)
+    budget = get_memory_budget(MEMORY_BUDGET)
+    num_workers, group_cost = plan_workers(
+        date_costs, max(num_cpus // 2, 1), budget, PIPELINE_DEPTH, num_decode_process
+    )
+    date_groups = plan_date_groups(date_costs, group_cost)
+    print(
+        f"Memory budget {budget / 1e6:.0f} MB: {num_workers} workers, "
+        f"{len(date_groups)} groups of up to {group_cost / 1e6:.0f} MB"
     )
-    cursor = db.connection.cursor()
-    cursor.execute("DELETE FROM error_dates")
+    work_queue = make_work_queue(date_groups, num_workers)
+    if PROFILE:
+        profiling.clear_profiles()
+    # the workers pull the date groups, biggest first, until the queue is empty
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=init_worker,
+        initargs=(
+            files_df,
+            symbol_to_companies,
+            work_queue,
+            len(date_groups),
+            num_threads,
+            num_decode_process,
+            partial_days,
+        ),
+    ) as executor:
+        futures = [executor.submit(process_date_groups) for _ in range(num_workers)]
+        workers_stats = []
+        for future in futures:
+            try:
+                workers_stats.append(future.result())
+            except Exception as e:
+                # its files are not in file_done, the next run ingests them
+                print("Worker failed: ", repr(e))
+    if len(workers_stats) > 0:
+        log_utilization(workers_stats)
+        print(f"New companies: {sum(s['companies'] for s in workers_stats)}")
+        log_dedup(workers_stats)
+    if PROFILE:
+        profiling.write_summary()
+    db.refresh_rollups()
+    if STOCKS_COMPRESSION:
+        print(f"Compressed {db.compress_backfilled_chunks()} stocks chunks")
+    if ANALYTICS_STORE:
+        update_store(db)
+    nb_quarantined = db.raw_query("SELECT count(*) FROM quarantine")[0][0]
     db.commit()
+    if nb_quarantined > 0:
+        print(f"{nb_quarantined} files in quarantine, see python3 analyze.py retry")
+    return workers_stats
 
 
 @timer_decorator
@@ -165,50 +435,145 @@ def update_timescale_db(
     num_cpus: int,
     num_threads: int,
     files_infos_df: Optional[pd.DataFrame] = None,
+    num_decode_process: int = DECODE_PROCESSES,
 ):
     if files_infos_df is None:
-        files_infos_df = get_files_infos_df()
-    symbol_to_companies = {
-        v: k for k, v in dict(db.raw_query("SELECT id, symbol FROM companies")).items()
-    }
-    if len(symbol_to_companies) == 0:
-        update_companies(db, files_infos_df, num_cpus, num_threads)
-        symbol_to_companies = {
-            v: k
-            for k, v in dict(db.raw_query("SELECT id, symbol FROM companies")).items()
-        }
+        files_infos_df = get_manifest_files_infos_df()
+    if SNAPSHOT_CACHE:
+        update_cache(files_infos_df, num_cpus)
     files_not_dones_df = get_file_not_dones_df(db, files_infos_df)
     if len(files_not_dones_df) > 0:
-        dates = files_not_dones_df["date"].unique()
-        date_groups = np.array_split(dates, len(dates) // 4)
-        date_groups = date_groups[:]
-        indexes = np.arange(1, len(date_groups) + 1)
-        process_date_group_partial = partial(
-            process_date_group2,
-            symbol_to_companies=symbol_to_companies,
-            files_infos_df=files_not_dones_df,
-            nb_date_group=len(date_groups),
-            num_thread=num_threads,
-        )
-        # process_date_group_partial(date_groups[0], index=[0])
-        with concurrent.futures.ProcessPoolExecutor(max_workers=num_cpus//2) as executor:
-            executor.map(process_date_group_partial, date_groups, indexes)
-    errors_dates = db.raw_query("SELECT * from error_dates")
-    if len(errors_dates) > 0:
-        update_companies_errors(
-            db=db,
-            error_dates=errors_dates,
-            files_infos_df=files_infos_df,
-            num_cpus=num_cpus,
-            num_thread=num_threads,
-            existing_symbols=[k for k, _ in symbol_to_companies.items()],
+        ingest_files(
+            db,
+            files_not_dones_df,
+            num_cpus,
+            num_threads,
+            num_decode_process,
+            get_partial_days(files_infos_df, files_not_dones_df),
         )
-        update_timescale_db(db, num_cpus, num_threads, files_infos_df)
+
+
+@timer_decorator
+def retry_quarantined(
+    db: tsdb.TimescaleStockMarketModel,
+    num_cpus: int,
+    num_threads: int,
+    max_attempts: int = QUARANTINE_MAX_ATTEMPTS,
+):
+    """Ingest again the days of the quarantined files whose backoff elapsed
+
+    Bars are computed per day, so all the files of these days are read, except
+    the quarantined files which are not due yet.
+    """
+    names = db.get_retryable_files(
+        max_attempts, QUARANTINE_BACKOFF, QUARANTINE_MAX_BACKOFF
+    )
+    if len(names) == 0:
+        print("No quarantined file to retry")
+        return
+    waiting = set(r[0] for r in db.raw_query("SELECT name FROM quarantine"))
+    waiting.difference_update(names)
+    db.commit()
+    files_infos_df = get_manifest_files_infos_df()
+    days = files_infos_df.loc[files_infos_df["name"].isin(names), "date"].unique()
+    files_df = files_infos_df[
+        files_infos_df["date"].isin(days) & ~files_infos_df["name"].isin(list(waiting))
+    ]
+    print(f"Retrying {len(names)} quarantined files, {len(days)} days")
+    if len(files_df) > 0:
+        ingest_files(db, files_df, num_cpus, num_threads)
+
+
+def ingest_micro_batch(
+    db: tsdb.TimescaleStockMarketModel,
+    registry: SymbolRegistry,
+    companies_mids: dict,
+    files_df: pd.DataFrame,
+    num_thread: int,
+):
+    """Ingest new files in this process, completing their days"""
+    for day, day_files_df in files_df.groupby("date"):
+        stage = "read"
+        try:
+            read_errors: dict = {}
+            with metrics.timed("read"):
+                df = read_files_df(day_files_df, num_thread, errors=read_errors)
+            stage = "transform"
+            dedup_stats: dict = {}
+            with metrics.timed("resample"):
+                bars = transform_date_group(df, registry, companies_mids, dedup_stats)
+            metrics.count_dedup(dedup_stats)
+            stage = "write"
+            write_date_group(
+                db, registry, day_files_df, read_errors, *bars, partial_days=[day]
+            )
+        except Exception as e:
+            db.connection.rollback()
+            print(day, f"Error in {stage}: ", e)
+            db.quarantine_files(day_files_df, stage, get_error_reasons(e))
+            db.commit()
+            metrics.count_quarantined(stage, day_files_df)
+
+
+def watch(
+    db: tsdb.TimescaleStockMarketModel,
+    num_cpus: int,
+    num_threads: int,
+    interval: float = WATCH_INTERVAL,
+    settle: float = WATCH_SETTLE,
+):
+    """Ingest the snapshot files as they land in DATA_PATH, in micro-batches
+
+    The pending files are first ingested in batch. Then the year directories
+    are checked every ``interval`` seconds, or ``settle`` seconds after
+    inotify saw files land, and the new files unchanged for ``settle``
+    seconds are written in this process, completing today's daystocks.
+    """
+    files_infos_df = get_manifest_files_infos_df()
+    update_timescale_db(db, num_cpus, num_threads, files_infos_df)
+    db.create_staging_tables()
+    registry = SymbolRegistry(dict(db.raw_query("SELECT symbol, id FROM companies")))
+    companies_mids = get_companies_mids(db)
+    # the files landed during the batch are new
+    new_files = NewFiles(files_infos_df)
+    pending_df = new_files.get_new_files()
+    directory_watch = get_watch(DATA_PATH)
+    print(f"Watching {DATA_PATH}")
+    try:
+        while True:
+            if directory_watch.wait(interval):
+                time.sleep(settle)
+            new_files_df = new_files.get_new_files()
+            if len(new_files_df) > 0:
+                pending_df = pd.concat([pending_df, new_files_df]).sort_index()
+            if len(pending_df) == 0:
+                continue
+            # the files still being written wait for the next round
+            pending_df = restat(pending_df)
+            is_ready = pending_df["mtime"] < time.time_ns() - settle * 1e9
+            ready_files_df, pending_df = pending_df[is_ready], pending_df[~is_ready]
+            if len(ready_files_df) == 0:
+                continue
+            files_df = get_file_not_dones_df(db, ready_files_df)
+            if len(files_df) == 0:
+                continue
+            start_time = time.time()
+            ingest_micro_batch(db, registry, companies_mids, files_df, num_threads)
+            db.refresh_rollups()
+            print(f"Ingested {len(files_df)} files in {time.time() - start_time:.2f}s")
+    finally:
+        directory_watch.close()
 
 
 if __name__ == "__main__":
     db = init_db(setup=True, show_log_path=True)
     num_cpus, num_threads = multiprocessing.cpu_count(), 16
-    print("Start updating timescale db")
-    update_timescale_db(db, num_cpus, num_threads)
-    print("Finished updating timescale db")
\ No newline at end of file
+    with metrics.exporting():
+        if sys.argv[1:] == ["retry"]:
+            retry_quarantined(db, num_cpus, num_threads)
+        elif sys.argv[1:] == ["watch"]:
+            watch(db, num_cpus, num_threads)
+        else:
+            print("Start updating timescale db")
+            update_timescale_db(db, num_cpus, num_threads)
+            print("Finished updating timescale db")
\ No newline at end of file
@@ -0,0 +1,249 @@
+"""Minute bars and daily OHLC of snapshot ticks in one NumPy pass.
+
+The ticks are sorted once by (cid, time). Minute bars and days are then runs
+of equal (cid, minute) and (cid, day) keys in that order, aggregated with
+``np.ufunc.reduceat``. Daily open, high, low, close, mean and std come from
+the raw ticks instead of the minute means, ``nb`` counting the ticks and
+``open_date`` and ``close_date`` dating the first and last ones so that days
+can be completed later, see ``accumulate_staged_daystocks``.
+
+With ``dedup`` the ticks which repeat the previous snapshot of their symbol
+are dropped before the aggregation. The minutes holding only repeats get the
+bar of the last change, as the forward fill of the minute bars. The repeats
+still weigh in the daily mean, std and ``nb``, except the copies of a tick
+in the file of another market.
+"""
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+NS_PER_MINUTE = 60 * 10**9
+NS_PER_DAY = 24 * 60 * NS_PER_MINUTE
+
+
+def get_cids_by_code(symbols: pd.Index, symbol_to_companies: dict) -> np.ndarray:
+    """Company id of every category of a symbol categorical"""
+    cids_by_code = symbols.map(symbol_to_companies)
+    unknown = pd.isna(cids_by_code)
+    if unknown.any():
+        raise ValueError("Unknown symbols: %s" % ", ".join(symbols[unknown]))
+    return np.asarray(cids_by_code, dtype=np.int16)
+
+
+def run_starts(*keys: np.ndarray) -> np.ndarray:
+    """Indexes where a run of equal keys starts in sorted arrays"""
+    change = np.zeros(len(keys[0]), dtype=bool)
+    change[:1] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(change)
+
+
+def nanmean_reduceat(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(valid, values, 0), starts)
+    counts = np.add.reduceat(valid.astype(np.int64), starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def ffill_runs(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """Forward fill NaNs without crossing the run boundaries"""
+    positions = np.arange(len(values))
+    is_start = np.zeros(len(values), dtype=bool)
+    is_start[starts] = True
+    source = np.where(~np.isnan(values) | is_start, positions, 0)
+    return values[np.maximum.accumulate(source)]
+
+
+def same_as_previous(values: np.ndarray) -> np.ndarray:
+    """values[i] == values[i - 1], NaNs being equal, for i >= 1"""
+    same = values[1:] == values[:-1]
+    if values.dtype.kind == "f":
+        same |= np.isnan(values[1:]) & np.isnan(values[:-1])
+    return same
+
+
+def get_deltas(
+    cid: np.ndarray,
+    ns: np.ndarray,
+    last: np.ndarray,
+    volume: np.ndarray,
+    market: Optional[np.ndarray] = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Ticks which change their symbol, in sorted arrays, and their weight
+
+    Returns the mask of the changes, the weight of each change, which counts
+    the repeats following it, and the mask of the repeats which are copies
+    from another market less than a minute later, which weigh nothing. The
+    first tick of each company and day is a change, so that the days keep
+    their bars.
+    """
+    day = ns // NS_PER_DAY
+    repeat = np.zeros(len(cid), dtype=bool)
+    repeat[1:] = (
+        same_as_previous(cid)
+        & same_as_previous(day)
+        & same_as_previous(last)
+        & same_as_previous(volume)
+    )
+    copy = np.zeros(len(cid), dtype=bool)
+    if market is not None:
+        copy[1:] = repeat[1:] & ~same_as_previous(market) & (np.diff(ns) < NS_PER_MINUTE)
+    keep = ~repeat
+    weight = np.bincount(np.cumsum(keep) - 1, weights=~copy, minlength=int(keep.sum()))
+    return keep, weight, copy
+
+
+def ticks_to_bars(
+    cid: np.ndarray,
+    date: np.ndarray,
+    last: np.ndarray,
+    volume: np.ndarray,
+    market: Optional[np.ndarray] = None,
+    dedup: bool = False,
+    stats: Optional[dict] = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Return the minute bars and the daily bars of the ticks.
+
+    cid    -- company id of every tick
+    date   -- datetime64[ns] of every tick
+    last   -- price of every tick, NaN when unknown
+    volume -- cumulated volume of the day, negative when unknown
+    market -- market code of every tick, to tell the copies with ``dedup``
+
+    Minute bars hold the mean price and volume of the minute, the volume is
+    forward filled per company. Bars and ticks with neither a positive price
+    nor a positive volume are dropped. With ``dedup`` the repeated ticks are
+    dropped before resampling, the minutes holding only repeats get the bar
+    of their last change, and a ``stats`` dict receives the number of ticks,
+    of repeats and of copies cut.
+    """
+    ns = date.astype("datetime64[ns]").view(np.int64)
+    volume = np.where(volume < 0, np.nan, volume.astype(np.float64))
+    order = np.lexsort((ns, cid))
+    cid, ns, last, volume = cid[order], ns[order], last[order], volume[order]
+    minute = ns // NS_PER_MINUTE
+    weight = np.ones(len(cid))
+    end_ns = ns  # time of the last tick each tick stands for
+    if dedup:
+        if market is not None:
+            market = market[order]
+        keep, weight, copy = get_deltas(cid, ns, last, volume, market)
+        all_starts = run_starts(cid, minute)
+        all_cid, all_minute = cid[all_starts], minute[all_starts]
+        kept = np.flatnonzero(keep)
+        # the copies of another market do not make the day any longer
+        last_own = np.maximum.accumulate(np.where(copy, 0, np.arange(len(keep))))
+        ends = np.append(kept[1:], len(keep)) - 1 if len(kept) > 0 else kept
+        end_ns = ns[last_own[ends]]
+        cid, ns, minute, last, volume = (
+            cid[keep], ns[keep], minute[keep], last[keep], volume[keep]
+        )
+        if stats is not None:
+            stats["ticks"] = stats.get("ticks", 0) + len(keep)
+            stats["repeats"] = stats.get("repeats", 0) + int((~keep).sum() - copy.sum())
+            stats["copies"] = stats.get("copies", 0) + int(copy.sum())
+
+    # minute bars
+    starts = run_starts(cid, minute)
+    bars_cid, bars_minute = cid[starts], minute[starts]
+    bars_value = nanmean_reduceat(last, starts)
+    bars_volume = ffill_runs(nanmean_reduceat(volume, starts), run_starts(bars_cid))
+    if dedup:
+        # the first tick of each company and day is kept, the fill stays in it
+        bars_key = (bars_cid.astype(np.int64) << 32) + bars_minute
+        all_key = (all_cid.astype(np.int64) << 32) + all_minute
+        filled = np.searchsorted(bars_key, all_key, side="right") - 1
+        bars_cid, bars_minute = all_cid, all_minute
+        bars_value, bars_volume = bars_value[filled], bars_volume[filled]
+    keep = (bars_volume > 0) | (bars_value > 0)
+    df_stocks = pd.DataFrame(
+        {
+            "cid": bars_cid[keep],
+            "value": bars_value[keep].astype(np.float32),
+            "volume": np.nan_to_num(bars_volume[keep]).astype(np.int64),
+        },
+        index=pd.DatetimeIndex(
+            (bars_minute[keep] * NS_PER_MINUTE).view("datetime64[ns]"), name="date"
+        ),
+    )
+
+    # daily bars, from the ticks
+    volume = ffill_runs(volume, run_starts(cid))
+    keep = ~np.isnan(last) & ((last > 0) | (volume > 0))
+    cid, ns, last, volume = cid[keep], ns[keep], last[keep], volume[keep]
+    weight, end_ns = weight[keep], end_ns[keep]
+    day = ns // NS_PER_DAY
+    starts = run_starts(cid, day)
+    ends = np.append(starts[1:], len(cid)) - 1 if len(starts) > 0 else starts
+    lengths = np.diff(np.append(starts, len(cid)))
+    counts = np.add.reduceat(weight, starts) if len(starts) > 0 else weight[:0]
+    mean = np.add.reduceat(weight * last, starts) / counts
+    squares = np.add.reduceat(weight * (last - np.repeat(mean, lengths)) ** 2, starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        std = np.where(counts > 1, np.sqrt(squares / (counts - 1)), 0)
+    df_daystocks = pd.DataFrame(
+        {
+            "date": (day[starts] * NS_PER_DAY).view("datetime64[ns]"),
+            "cid": cid[starts],
+            "open": last[starts],
+            "close": last[ends],
+            "high": np.maximum.reduceat(last, starts),
+            "low": np.minimum.reduceat(last, starts),
+            "volume": np.nan_to_num(volume[ends]).astype(np.int64),
+            "mean": mean,
+            "std": std,
+            "nb": counts.astype(np.int32),
+            "open_date": ns[starts].view("datetime64[ns]"),
+            "close_date": end_ns[ends].view("datetime64[ns]"),
+        }
+    ).set_index(["date", "cid"])
+    return df_stocks, df_daystocks
+
+
+def df_to_code_bars(
+    df: pd.DataFrame, dedup: bool = False, stats: Optional[dict] = None
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """``ticks_to_bars`` of a DataFrame read by ``utils.read_files_df``
+
+    The ``cid`` of the bars are the codes of the ``symbol`` categorical, rows
+    without symbol are dropped.
+    """
+    codes = np.asarray(df["symbol"].array.codes, dtype=np.int32)  # type: ignore
+    has_symbol = codes >= 0
+    market = None
+    if "market" in df.columns:
+        market = np.asarray(df["market"].array.codes)[has_symbol]  # type: ignore
+    return ticks_to_bars(
+        codes[has_symbol],
+        df.index.to_numpy()[has_symbol],
+        df["last"].to_numpy(dtype=np.float64)[has_symbol],
+        df["volume"].to_numpy(dtype=np.float64)[has_symbol],
+        market,
+        dedup,
+        stats,
+    )
+
+
+def relabel_cids(
+    df_stocks: pd.DataFrame, df_daystocks: pd.DataFrame, cids_by_code: np.ndarray
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Replace the symbol codes of ``df_to_code_bars`` by company ids"""
+    df_stocks = df_stocks.assign(cid=cids_by_code[df_stocks["cid"].to_numpy()])
+    dates = df_daystocks.index.get_level_values("date")
+    codes = df_daystocks.index.get_level_values("cid").to_numpy()
+    df_daystocks = df_daystocks.set_axis(
+        pd.MultiIndex.from_arrays([dates, cids_by_code[codes]], names=["date", "cid"])
+    )
+    return df_stocks, df_daystocks
+
+
+def df_to_bars(
+    df: pd.DataFrame, symbol_to_companies: dict
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Minute and daily bars of a DataFrame read by ``utils.read_files_df``"""
+    cids_by_code = get_cids_by_code(df["symbol"].cat.categories, symbol_to_companies)
+    return relabel_cids(*df_to_code_bars(df), cids_by_code)
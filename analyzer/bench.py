@@ -0,0 +1,642 @@
+"""Benchmarks of the analyzer ingest path on synthetic boursorama files.
+
+  python3 bench.py read [files_per_market]
+  python3 bench.py decode [files_per_market] [max_process]
+  python3 bench.py copy [nb_rows]      (needs the database of analyze.init_db)
+  python3 bench.py bars [files_per_market]
+  python3 bench.py dedup [files_per_market] [nb_days]
+  python3 bench.py cache [files_per_market] [nb_days]
+  python3 bench.py storage             (compresses the stocks of analyze.init_db)
+  python3 bench.py ingest [scale]      (runs a throwaway TimescaleDB container)
+  python3 bench.py logging [nb_records] [nb_init_db]
+
+The ingest benchmark generates ``scale`` times the data of ``synthetic.py``
+then runs every ingest stage in a fresh process, against a throwaway
+database, reporting files/s, rows/s and the peak memory of the stage. The
+results are kept in bench_ingest_<scale>x.json, a later run fails if a stage
+got more than REGRESSION_TOLERANCE slower or bigger, keeping the old results.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import csv
+import io
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from analyze import (
+    get_companies_mids,
+    ingest_files,
+    init_db,
+    transform_date_group,
+    write_date_group,
+)
+from bars import df_to_bars, df_to_code_bars
+from binary_copy import BinaryCopyStream, to_copy_array
+from constant import BENCH_DB_IMAGE, BENCH_DB_PORT, SNAPSHOT_DEDUP
+from manifest import get_manifest_files_infos_df
+import mylogging
+from scheduler import get_max_rss
+from shared_decode import process_read_files_df
+from snapshot_cache import read_snapshots, update_cache
+from symbol_registry import SymbolRegistry
+from synthetic import FILES_PER_MARKET, MARKETS_NB_SYMBOLS, PEAPME_SOURCES
+from synthetic import get_scale_days
+from synthetic import make_synthetic_day, write_synthetic_data
+from utils import get_files_infos_df, multi_read_df_from_paths, read_files_df
+
+REGRESSION_TOLERANCE = 0.2
+# smaller differences are noise
+REGRESSION_MIN_SECONDS = 0.5
+REGRESSION_MIN_BYTES = 20 * 1024**2
+THROWAWAY_DB_PORT = 55432
+
+
+def best_time(func, repeat=3) -> float:
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def bench_read(files_per_market: int = 100, num_thread: int = 16):
+    for extension in ["bz2", "pkl"]:
+        with tempfile.TemporaryDirectory() as data_path:
+            make_synthetic_day(
+                data_path, files_per_market=files_per_market, extension=extension
+            )
+            files_infos_df = get_files_infos_df(data_path=data_path)
+            paths = list(files_infos_df["path"])
+            old = best_time(lambda: multi_read_df_from_paths(paths, num_thread))
+            new = best_time(lambda: read_files_df(files_infos_df, num_thread))
+        print(f"{len(paths)} .{extension} files")
+        print(f"  multi_read_df_from_paths: {old:.3f}s")
+        print(f"  read_files_df:            {new:.3f}s ({old / new:.1f}x)")
+
+
+def bench_decode(files_per_market: int = 100, max_process: int = 0):
+    max_process = max_process or multiprocessing.cpu_count()
+    with tempfile.TemporaryDirectory() as data_path:
+        make_synthetic_day(data_path, files_per_market=files_per_market)
+        files_infos_df = get_files_infos_df(data_path=data_path)
+        nb_files = len(files_infos_df)
+        threads = best_time(lambda: read_files_df(files_infos_df, 16))
+        print(f"16 threads:  {nb_files / threads:.0f} files/s")
+        num_process = 1
+        while num_process <= max_process:
+            process_read_files_df(files_infos_df, num_process)  # start the pool
+            duration = best_time(
+                lambda: process_read_files_df(files_infos_df, num_process)
+            )
+            print(f"{num_process:2d} process: {nb_files / duration:.0f} files/s")
+            num_process *= 2
+
+
+def make_stocks_df(nb_rows: int, seed=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "cid": rng.integers(1, 2000, nb_rows).astype(np.int16),
+            "value": rng.lognormal(3, 1, nb_rows).astype(np.float32),
+            "volume": rng.integers(0, 10_000_000, nb_rows),
+        },
+        index=pd.DatetimeIndex(
+            pd.Timestamp("2021-03-02 09:00")
+            + pd.to_timedelta(rng.integers(0, 30_600, nb_rows), unit="s"),
+            name="date",
+        ),
+    )
+
+
+def encode_csv(df: pd.DataFrame) -> int:
+    """Encode like TimescaleStockMarketModel.psql_insert_copy does"""
+    s_buf = io.StringIO()
+    csv.writer(s_buf).writerows(df.reset_index().itertuples(index=False))
+    return len(s_buf.getvalue())
+
+
+def encode_binary(df: pd.DataFrame) -> int:
+    pg_types = ["timestamptz", "int2", "float4", "int8"]
+    df = df.reset_index()
+    columns = [to_copy_array(df[c].to_numpy(), t, "UTC") for c, t in zip(df, pg_types)]
+    stream = BinaryCopyStream([c[0] for c in columns], [c[1] for c in columns], pg_types)
+    while stream.read(1 << 20):
+        pass
+    return stream.nbytes
+
+
+def bench_copy(nb_rows: int = 2_000_000):
+    df = make_stocks_df(nb_rows)
+    csv_time = best_time(lambda: encode_csv(df), repeat=1)
+    binary_time = best_time(lambda: encode_binary(df), repeat=1)
+    print(f"{nb_rows} rows, encoding only")
+    print(f"  csv:    {csv_time:.2f}s, {encode_csv(df) / 1e6:.0f} MB")
+    print(f"  binary: {binary_time:.2f}s, {encode_binary(df) / 1e6:.0f} MB")
+    db = init_db()
+    db.execute("DROP TABLE IF EXISTS bench_stocks")
+    db.execute("CREATE UNLOGGED TABLE bench_stocks (LIKE stocks)", commit=True)
+    try:
+        df_write = best_time(lambda: db.df_write(df, "bench_stocks", commit=True), 1)
+        copy_write = best_time(
+            lambda: db.copy_write(df, "bench_stocks", commit=True), 1
+        )
+    finally:
+        db.execute("DROP TABLE bench_stocks", commit=True)
+    print(f"{nb_rows} rows into the database")
+    print(f"  df_write:   {df_write:.2f}s, {nb_rows / df_write:.0f} rows/s")
+    print(f"  copy_write: {copy_write:.2f}s, {nb_rows / copy_write:.0f} rows/s")
+
+
+def pandas_stocks(df: pd.DataFrame, symbol_to_companies: dict) -> pd.DataFrame:
+    """Minute bars the way analyze did it before the NumPy kernel"""
+    df_stocks = df.drop(columns=["name", "last_suffix", "market"])
+    df_stocks["volume"] = df_stocks["volume"].apply(lambda x: np.nan if x < 0 else x)
+    df_stocks = df_stocks.groupby(
+        ["symbol", pd.Grouper(level=0, freq="1min")], observed=True
+    ).mean()
+    df_stocks["volume"] = df_stocks["volume"].ffill()
+    df_stocks = df_stocks[(df_stocks["volume"] > 0) | (df_stocks["last"] > 0)]
+    df_stocks = df_stocks.reset_index(level="symbol")
+    df_stocks["cid"] = df_stocks["symbol"].map(symbol_to_companies).astype(np.int16)
+    return pd.DataFrame(
+        {
+            "cid": df_stocks["cid"],
+            "value": df_stocks["last"].astype(np.float32),
+            "volume": df_stocks["volume"].astype(np.int64),
+        }
+    )
+
+
+def pandas_daystocks(df_stocks: pd.DataFrame) -> pd.DataFrame:
+    """Daily bars of the minute means, as analyze did it before"""
+    df_stocks = df_stocks.reset_index()
+    df_stocks["date"] = df_stocks["date"].dt.date
+    return (
+        df_stocks.groupby(["date", "cid"])
+        .agg(
+            open=("value", "first"),
+            close=("value", "last"),
+            high=("value", "max"),
+            low=("value", "min"),
+            volume=("volume", "last"),
+            mean=("value", "mean"),
+            std=("value", "std"),
+        )
+        .fillna(0)
+    )
+
+
+def pandas_tick_daystocks(df: pd.DataFrame, symbol_to_companies: dict) -> pd.DataFrame:
+    """Daily bars of the raw ticks with pandas, the reference of the kernel"""
+    df = df[["symbol", "last", "volume"]].reset_index()
+    df["cid"] = df["symbol"].map(symbol_to_companies).astype(np.int16)
+    df["volume"] = df["volume"].where(df["volume"] >= 0)
+    df = df.sort_values(["cid", "date"], kind="stable")
+    df["volume"] = df.groupby("cid")["volume"].ffill()
+    df = df[df["last"].notna() & ((df["last"] > 0) | (df["volume"] > 0))]
+    df["tick_date"] = df["date"]
+    df["date"] = df["date"].dt.normalize()
+    df_daystocks = df.groupby(["date", "cid"]).agg(
+        open=("last", "first"),
+        close=("last", "last"),
+        high=("last", "max"),
+        low=("last", "min"),
+        volume=("volume", "last"),
+        mean=("last", "mean"),
+        std=("last", "std"),
+        nb=("last", "size"),
+        open_date=("tick_date", "first"),
+        close_date=("tick_date", "last"),
+    )
+    df_daystocks = df_daystocks.fillna(0)
+    df_daystocks["volume"] = df_daystocks["volume"].astype(np.int64)
+    df_daystocks["nb"] = df_daystocks["nb"].astype(np.int32)
+    return df_daystocks
+
+
+def bench_bars(files_per_market: int = 600):
+    with tempfile.TemporaryDirectory() as data_path:
+        make_synthetic_day(data_path, files_per_market=files_per_market)
+        df = read_files_df(get_files_infos_df(data_path=data_path), 16)
+    symbols = df["symbol"].cat.categories
+    symbol_to_companies = dict(zip(symbols, range(1, len(symbols) + 1)))
+
+    df_stocks, df_daystocks = df_to_bars(df, symbol_to_companies)
+    expected_stocks = pandas_stocks(df, symbol_to_companies)
+    expected_stocks = expected_stocks.sort_values(["cid", "date"], kind="stable")
+    pd.testing.assert_frame_equal(df_stocks, expected_stocks, check_index_type=False)
+    expected_daystocks = pandas_tick_daystocks(df, symbol_to_companies)
+    pd.testing.assert_frame_equal(df_daystocks, expected_daystocks)
+    print(f"{len(df)} ticks, {len(df_stocks)} minute bars, same as pandas")
+
+    old_daystocks = pandas_daystocks(expected_stocks)
+    moved = ~np.isclose(old_daystocks["high"], df_daystocks["high"]) | ~np.isclose(
+        old_daystocks["low"], df_daystocks["low"]
+    )
+    print(f"  high or low of {moved.mean():.0%} of the days differ from the minute means")
+
+    def pandas_bars():
+        df_stocks = pandas_stocks(df, symbol_to_companies)
+        return df_stocks, pandas_daystocks(df_stocks)
+
+    old = best_time(pandas_bars)
+    new = best_time(lambda: df_to_bars(df, symbol_to_companies))
+    print(f"  pandas:     {old:.3f}s")
+    print(f"  df_to_bars: {new:.3f}s ({old / new:.1f}x)")
+
+
+def without_copies(df: pd.DataFrame) -> pd.DataFrame:
+    """Snapshots without the peapme ticks of the symbols of compA and compB"""
+    sources = df.loc[df["market"].isin(PEAPME_SOURCES), "symbol"].unique()
+    return df[~((df["market"] == "peapme") & df["symbol"].isin(sources))]
+
+
+def stale_ticks_df(nb_days: int = 2) -> pd.DataFrame:
+    """Two snapshots a day of a symbol which neither trades nor moves"""
+    dates = [
+        day + pd.Timedelta(hours=hours)
+        for day in pd.bdate_range("2023-01-02", periods=nb_days)
+        for hours in (9, 17)
+    ]
+    return pd.DataFrame(
+        {
+            "symbol": pd.Categorical(["1rPSTALE"] * len(dates)),
+            "last": 5.0,
+            "volume": 0,
+            "market": pd.Categorical(["compB"] * len(dates)),
+        },
+        index=pd.DatetimeIndex(dates, name="date"),
+    )
+
+
+def bench_dedup(files_per_market: int = 100, nb_days: int = 3):
+    with tempfile.TemporaryDirectory() as data_path:
+        for day in pd.bdate_range("2021-03-01", periods=nb_days):
+            make_synthetic_day(data_path, f"{day:%Y-%m-%d}", files_per_market)
+        copied_df = read_files_df(get_files_infos_df(data_path=data_path), 16)
+    df = without_copies(copied_df)
+    # every day of a stale symbol keeps its bar and its ticks
+    stale_df = stale_ticks_df()
+    pd.testing.assert_frame_equal(
+        df_to_code_bars(stale_df, dedup=True)[1], df_to_code_bars(stale_df)[1]
+    )
+    full_stocks, full_daystocks = df_to_code_bars(df)
+    stats: dict = {}
+    df_stocks, df_daystocks = df_to_code_bars(df, dedup=True, stats=stats)
+    pd.testing.assert_frame_equal(df_daystocks, full_daystocks)
+    # the minutes of the repeats are filled with the bar of their last change
+    pd.testing.assert_frame_equal(df_stocks, full_stocks)
+    print(f"{nb_days} days, {stats['ticks']} ticks, {stats['repeats']} unchanged cut")
+    print("  minute bars same as without dedup")
+    print("  daily bars same as without dedup")
+
+    copied_stats: dict = {}
+    _, copied_daystocks = df_to_code_bars(copied_df, dedup=True, stats=copied_stats)
+    pd.testing.assert_frame_equal(copied_daystocks, df_daystocks)
+    print(f"{copied_stats['copies']} copies of compA and compB ticks in peapme cut")
+    print("  daily bars same as without the copies")
+
+    old = best_time(lambda: df_to_code_bars(copied_df))
+    new = best_time(lambda: df_to_code_bars(copied_df, dedup=True))
+    print(f"  df_to_code_bars:             {old:.3f}s")
+    print(f"  df_to_code_bars with dedup:  {new:.3f}s ({old / new:.1f}x)")
+
+
+def directory_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+def bench_cache(files_per_market: int = 100, nb_days: int = 4):
+    with tempfile.TemporaryDirectory() as data_path:
+        for day in pd.bdate_range("2021-03-01", periods=nb_days):
+            make_synthetic_day(data_path, f"{day:%Y-%m-%d}", files_per_market)
+        files_infos_df = get_files_infos_df(data_path=data_path)
+        cache_path = os.path.join(data_path, "cache")
+        start_time = time.perf_counter()
+        update_cache(files_infos_df, multiprocessing.cpu_count(), cache_path=cache_path)
+        convert = time.perf_counter() - start_time
+
+        df = read_files_df(files_infos_df, 16)
+        cached_df = read_snapshots(files_infos_df, 16, cache_path=cache_path)
+        pd.testing.assert_frame_equal(
+            cached_df, df, check_categorical=False, check_index_type=False
+        )
+        # a subset of the files of each day is filtered out of the cache files
+        subset_df = files_infos_df.iloc[::3]
+        pd.testing.assert_frame_equal(
+            read_snapshots(subset_df, 16, cache_path=cache_path),
+            read_files_df(subset_df, 16),
+            check_categorical=False,
+            check_index_type=False,
+        )
+
+        pickles = best_time(lambda: read_files_df(files_infos_df, 16))
+        cached = best_time(lambda: read_snapshots(files_infos_df, 16, cache_path=cache_path))
+        pruned = best_time(
+            lambda: read_snapshots(
+                files_infos_df, 16, ["symbol", "name"], cache_path=cache_path
+            )
+        )
+        pickles_size = directory_size(data_path) - directory_size(cache_path)
+        cache_size = directory_size(cache_path)
+    print(f"{len(files_infos_df)} files, {len(df)} rows, same as the pickles")
+    print(f"  conversion:            {convert:.2f}s")
+    print(f"  pickles:       {pickles_size / 1e6:5.1f} MB, read {pickles:.3f}s")
+    print(f"  parquet cache: {cache_size / 1e6:5.1f} MB, read {cached:.3f}s ({pickles / cached:.1f}x)")
+    print(f"  symbol, name only:           read {pruned:.3f}s ({pickles / pruned:.1f}x)")
+
+
+def report_stocks_storage(db, label: str):
+    """Print the size of stocks and the latency of a scan of one company"""
+    storage = db.get_stocks_storage()
+    cid, start, end = db.raw_query(
+        "SELECT cid, min(date), max(date) FROM stocks "
+        "GROUP BY cid ORDER BY count(*) DESC LIMIT 1"
+    )[0]
+    scan = best_time(
+        lambda: db.raw_query(
+            "SELECT date, value, volume FROM stocks "
+            "WHERE cid = %s AND date >= %s AND date <= %s",
+            (cid, start, end),
+        ),
+        repeat=5,
+    )
+    db.commit()
+    print(
+        f"{label}: {storage['bytes'] / 1e6:.0f} MB, "
+        f"{storage['compressed_chunks']}/{storage['chunks']} chunks compressed, "
+        f"range scan of cid {cid}: {scan * 1000:.1f}ms"
+    )
+
+
+def bench_storage():
+    db = init_db()
+    report_stocks_storage(db, "before")
+    db.setup_stocks_storage()
+    print(f"compressed {db.compress_backfilled_chunks()} chunks")
+    report_stocks_storage(db, "after ")
+
+
+def get_file_logger(name: str, path: str, nb_handlers: int) -> logging.Logger:
+    """Logger as the synchronous mylogging left it after ``nb_handlers`` init_db"""
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    for _ in range(nb_handlers):
+        fh = logging.handlers.RotatingFileHandler(
+            path, maxBytes=10 * 1024**2, backupCount=3
+        )
+        fh.setFormatter(
+            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        )
+        logger.addHandler(fh)
+    return logger
+
+
+def bench_logging(nb_records: int = 20000, nb_init_db: int = 3):
+    """Cost of the debug logs of execute, per query"""
+    query = "INSERT INTO stocks SELECT * FROM stage_stocks ON CONFLICT (date, cid) DO UPDATE"
+    args = (1, "1rPAB", 12.5)
+
+    def eager(logger):
+        for _ in range(nb_records):
+            logger.debug("SQL: QUERY: %s" % ("%s %% %r" % (query, args)))
+
+    def lazy(logger):
+        for _ in range(nb_records):
+            logger.debug("SQL: QUERY: %s %% %r", query, args)
+
+    with tempfile.TemporaryDirectory() as log_path:
+        synchronous = get_file_logger(
+            "bench.sync", os.path.join(log_path, "sync.log"), nb_init_db
+        )
+        for _ in range(nb_init_db):
+            queued = mylogging.getLogger(
+                "bench.queue", mylogging.DEBUG, os.path.join(log_path, "queue.log")
+            )
+        old = best_time(lambda: eager(synchronous), repeat=1)
+        new_debug = best_time(lambda: lazy(queued), repeat=1)
+        queued.setLevel(mylogging.INFO)
+        new_info = best_time(lambda: lazy(queued), repeat=1)
+        mylogging.stop_listeners()
+    print(f"{nb_records} debug records, {nb_init_db} init_db")
+    per_query = 1e6 / nb_records
+    print(f"  synchronous, {len(synchronous.handlers)} handlers: {old * per_query:6.2f} us/query")
+    print(
+        f"  queue, DEBUG, {len(queued.handlers)} handler:     "
+        f"{new_debug * per_query:6.2f} us/query ({old / new_debug:.1f}x)"
+    )
+    print(
+        f"  queue, INFO:                {new_info * per_query:6.2f} us/query "
+        f"({old / new_info:.0f}x)"
+    )
+
+
+def stage_manifest() -> dict:
+    start_time = time.perf_counter()
+    files_infos_df = get_manifest_files_infos_df()
+    duration = time.perf_counter() - start_time
+    return {"files": len(files_infos_df), "rows": len(files_infos_df), "seconds": duration}
+
+
+def stage_read() -> dict:
+    files_infos_df = get_manifest_files_infos_df()
+    start_time = time.perf_counter()
+    rows = sum(
+        len(read_files_df(files_df, 16)) for _, files_df in files_infos_df.groupby("date")
+    )
+    duration = time.perf_counter() - start_time
+    return {"files": len(files_infos_df), "rows": rows, "seconds": duration}
+
+
+def stage_bars() -> dict:
+    files_infos_df = get_manifest_files_infos_df()
+    rows, duration = 0, 0.0
+    for _, files_df in files_infos_df.groupby("date"):
+        df = read_files_df(files_df, 16)
+        start_time = time.perf_counter()
+        df_stocks, df_daystocks = df_to_code_bars(df, SNAPSHOT_DEDUP)
+        duration += time.perf_counter() - start_time
+        rows += len(df_stocks) + len(df_daystocks)
+    return {"files": len(files_infos_df), "rows": rows, "seconds": duration}
+
+
+def init_bench_db():
+    """Empty database of the benchmark, refusing to wipe any other one"""
+    connection = init_db(setup=True).connection
+    port = connection.info.port
+    connection.close()
+    if BENCH_DB_PORT <= 0 or port != BENCH_DB_PORT:
+        raise RuntimeError(
+            f"Database on port {port} is not the benchmark one, not wiping it"
+        )
+    return init_db(clean_setup=True)
+
+
+def stage_write() -> dict:
+    """Companies, bars and file_done of every day, written by one process"""
+    db = init_bench_db()
+    db.create_staging_tables()
+    registry = SymbolRegistry({})
+    companies_mids = get_companies_mids(db)
+    files_infos_df = get_manifest_files_infos_df()
+    rows, duration = 0, 0.0
+    for _, files_df in files_infos_df.groupby("date"):
+        df = read_files_df(files_df, 16)
+        bars = transform_date_group(df, registry, companies_mids)
+        start_time = time.perf_counter()
+        write_date_group(db, registry, files_df, {}, *bars)
+        duration += time.perf_counter() - start_time
+        rows += len(bars[2]) + len(bars[3])
+    return {"files": len(files_infos_df), "rows": rows, "seconds": duration}
+
+
+def stage_ingest() -> dict:
+    """The whole ingest with its workers, their peak memory is added up"""
+    db = init_bench_db()
+    files_infos_df = get_manifest_files_infos_df()
+    start_time = time.perf_counter()
+    workers_stats = ingest_files(db, files_infos_df, multiprocessing.cpu_count(), 16)
+    duration = time.perf_counter() - start_time
+    rows = db.raw_query(
+        "SELECT (SELECT count(*) FROM stocks) + (SELECT count(*) FROM daystocks)"
+    )[0][0]
+    return {
+        "files": len(files_infos_df),
+        "rows": rows,
+        "seconds": duration,
+        "max_rss": sum(s["max_rss"] for s in workers_stats),
+    }
+
+
+INGEST_STAGES = {
+    "manifest": stage_manifest,
+    "read": stage_read,
+    "bars": stage_bars,
+    "write": stage_write,
+    "ingest": stage_ingest,
+}
+
+
+def measure_stage(name: str) -> dict:
+    result = INGEST_STAGES[name]()
+    result["max_rss"] = result.get("max_rss", 0) + get_max_rss()
+    return result
+
+
+def run_stage(name: str) -> dict:
+    """Run a stage in a new process, which imports the constants of os.environ"""
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return executor.submit(measure_stage, name).result()
+
+
+@contextlib.contextmanager
+def throwaway_db():
+    """Port of a database the benchmark may wipe, a container by default"""
+    if BENCH_DB_PORT > 0:
+        yield BENCH_DB_PORT
+        return
+    container = subprocess.run(
+        [
+            "docker", "run", "-d", "--rm", "-p", f"{THROWAWAY_DB_PORT}:5432",
+            "-e", "POSTGRES_DB=bourse",
+            "-e", "POSTGRES_USER=ricou",
+            "-e", "POSTGRES_PASSWORD=monmdp",
+            BENCH_DB_IMAGE,
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    try:
+        # the server of the init scripts does not listen on tcp
+        ready = ["docker", "exec", container, "pg_isready", "-h", "127.0.0.1"]
+        for _ in range(60):
+            if subprocess.run(ready, capture_output=True).returncode == 0:
+                break
+            time.sleep(1)
+        else:
+            raise RuntimeError(f"Database container {container} not ready")
+        yield THROWAWAY_DB_PORT
+    finally:
+        subprocess.run(["docker", "stop", container], capture_output=True)
+
+
+def get_regressions(results: dict, baseline: dict) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key, unit, noise in [
+            ("seconds", "s", REGRESSION_MIN_SECONDS),
+            ("max_rss", " B", REGRESSION_MIN_BYTES),
+        ]:
+            old, new = baseline[name][key], result[key]
+            if new > old * (1 + REGRESSION_TOLERANCE) and new - old > noise:
+                regressions.append(f"{name} {key}: {old:.4g}{unit} -> {new:.4g}{unit}")
+    return regressions
+
+
+def bench_ingest(scale: int = 1):
+    data_path = os.path.join(tempfile.gettempdir(), f"bourse_synthetic_{scale}x")
+    start_time = time.perf_counter()
+    nb_days = write_synthetic_data(data_path, scale)
+    duration = time.perf_counter() - start_time
+    nb_files = len(get_scale_days(scale)) * len(MARKETS_NB_SYMBOLS) * FILES_PER_MARKET
+    print(f"{data_path}: {nb_files} files, {nb_days} days generated in {duration:.1f}s")
+
+    results = {}
+    with throwaway_db() as port:
+        os.environ["DATA_PATH"] = data_path
+        os.environ["MANIFEST_PATH"] = os.path.join(data_path, "manifest.pkl")
+        os.environ["DB_HOST"] = "localhost"
+        os.environ["DB_PORT"] = str(port)
+        # the stages only wipe the database on this port
+        os.environ["BENCH_DB_PORT"] = str(port)
+        for name in INGEST_STAGES:
+            results[name] = result = run_stage(name)
+            print(
+                f"  {name:8s} {result['files'] / result['seconds']:9.0f} files/s "
+                f"{result['rows'] / result['seconds']:11.0f} rows/s "
+                f"{result['seconds']:8.2f}s  peak memory {result['max_rss'] / 1e6:6.0f} MB"
+            )
+
+    results_path = f"bench_ingest_{scale}x.json"
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            regressions = get_regressions(results, json.load(f))
+        if len(regressions) > 0:
+            print(f"Regressions since {results_path}:", *regressions, sep="\n  ")
+            sys.exit(1)
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    benchmarks = {
+        "read": bench_read,
+        "decode": bench_decode,
+        "copy": bench_copy,
+        "bars": bench_bars,
+        "dedup": bench_dedup,
+        "cache": bench_cache,
+        "storage": bench_storage,
+        "ingest": bench_ingest,
+        "logging": bench_logging,
+    }
+    benchmarks[sys.argv[1]](*[int(a) for a in sys.argv[2:]])
@@ -0,0 +1,177 @@
+"""PostgreSQL binary COPY encoding from NumPy column arrays.
+
+Rows without NULLs are packed with one structured NumPy array per chunk, rows
+holding a NULL (NaN, NaT, None) or a text column go through ``struct``.
+
+  https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+"""
+
+import io
+import struct
+from typing import Iterator, Optional
+import numpy as np
+import pandas as pd
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+# microseconds between the unix and the postgres epochs
+POSTGRES_EPOCH_US = 946_684_800_000_000
+POSTGRES_EPOCH_DAYS = 10_957
+
+PG_TYPES = {
+    "smallint": "int2",
+    "integer": "int4",
+    "bigint": "int8",
+    "real": "float4",
+    "double precision": "float8",
+    "boolean": "bool",
+    "timestamp with time zone": "timestamptz",
+    "timestamp without time zone": "timestamp",
+    "date": "date",
+    "character varying": "text",
+    "character": "text",
+    "text": "text",
+}
+FIXED_DTYPES = {
+    "int2": ">i2",
+    "int4": ">i4",
+    "int8": ">i8",
+    "float4": ">f4",
+    "float8": ">f8",
+    "bool": "?",
+    "timestamptz": ">i8",
+    "timestamp": ">i8",
+    "date": ">i4",
+}
+
+
+def to_copy_array(
+    values, pg_type: str, timezone: Optional[str] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """Convert ``values`` to the array written for ``pg_type`` and its NULL mask.
+
+    Naive datetimes are read in ``timezone``, the session time zone, the way
+    the text COPY would do it.
+    """
+    if pg_type in ("timestamptz", "timestamp", "date"):
+        dates = pd.DatetimeIndex(pd.to_datetime(values))
+        if pg_type == "timestamptz" and dates.tz is None and timezone is not None:
+            dates = dates.tz_localize(timezone, ambiguous=False, nonexistent="shift_forward")
+        mask = np.asarray(dates.isna())
+        if dates.tz is not None and pg_type != "timestamptz":
+            dates = dates.tz_localize(None)
+        us = dates.as_unit("us").asi8
+        if pg_type == "date":
+            return (us // 86_400_000_000 - POSTGRES_EPOCH_DAYS).astype(np.int32), mask
+        return us - POSTGRES_EPOCH_US, mask
+    if pg_type == "text":
+        array = np.asarray(values, dtype=object)
+        return array, np.asarray(pd.isna(array))
+    array = np.asarray(values)
+    mask = np.asarray(pd.isna(array)) if array.dtype.kind in "fO" else None
+    if mask is None:
+        mask = np.zeros(len(array), dtype=bool)
+    return array, mask
+
+
+_pack_size = struct.Struct(">i").pack
+_NULL_FIELD = _pack_size(-1)
+
+
+def _pack_fields(array: np.ndarray, mask: np.ndarray, pg_type: str) -> list[bytes]:
+    """Return the size prefixed field of every value of ``array``."""
+    if pg_type == "text":
+        data = [str(v).encode() for v in array]
+        fields = [_pack_size(len(d)) + d for d in data]
+    else:
+        dtype = np.dtype(FIXED_DTYPES[pg_type])
+        array = array.copy()
+        array[mask] = 0  # NULLs, only there to be castable
+        raw = array.astype(dtype).tobytes()
+        prefix = _pack_size(dtype.itemsize)
+        fields = [
+            prefix + raw[i : i + dtype.itemsize]
+            for i in range(0, len(raw), dtype.itemsize)
+        ]
+    for i in np.flatnonzero(mask):
+        fields[i] = _NULL_FIELD
+    return fields
+
+
+def encode_rows(
+    arrays: list[np.ndarray], masks: list[np.ndarray], pg_types: list[str]
+) -> bytes:
+    """Encode the rows of ``arrays`` as binary COPY tuples."""
+    nb_rows = len(arrays[0]) if arrays else 0
+    slow = np.zeros(nb_rows, dtype=bool)
+    for mask in masks:
+        slow |= mask
+    if "text" in pg_types:
+        slow[:] = True
+    parts = []
+    fast = np.flatnonzero(~slow)
+    if len(fast) > 0:
+        dtype = [("nfields", ">i2")]
+        for i, pg_type in enumerate(pg_types):
+            dtype += [(f"size{i}", ">i4"), (f"value{i}", FIXED_DTYPES[pg_type])]
+        chunk = np.empty(len(fast), dtype=np.dtype(dtype))
+        chunk["nfields"] = len(pg_types)
+        for i, (array, pg_type) in enumerate(zip(arrays, pg_types)):
+            chunk[f"size{i}"] = np.dtype(FIXED_DTYPES[pg_type]).itemsize
+            chunk[f"value{i}"] = array[fast]
+        parts.append(chunk.tobytes())
+    slow_rows = np.flatnonzero(slow)
+    if len(slow_rows) > 0:
+        nfields = struct.pack(">h", len(pg_types))
+        columns = [
+            _pack_fields(array[slow_rows], mask[slow_rows], pg_type)
+            for array, mask, pg_type in zip(arrays, masks, pg_types)
+        ]
+        parts.extend(nfields + b"".join(fields) for fields in zip(*columns))
+    return b"".join(parts)
+
+
+class BinaryCopyStream(io.RawIOBase):
+    """File like object producing a binary COPY payload chunk by chunk.
+
+    Only ``chunk_rows`` rows are encoded at a time, so memory stays bounded
+    whatever the size of the DataFrame.
+    """
+
+    def __init__(
+        self,
+        arrays: list[np.ndarray],
+        masks: list[np.ndarray],
+        pg_types: list[str],
+        chunk_rows: int = 100_000,
+    ):
+        self.__chunks = self.__iter_chunks(arrays, masks, pg_types, chunk_rows)
+        self.__chunk = memoryview(b"")
+        self.nbytes = 0
+
+    @staticmethod
+    def __iter_chunks(arrays, masks, pg_types, chunk_rows) -> Iterator[bytes]:
+        yield COPY_HEADER
+        nb_rows = len(arrays[0]) if arrays else 0
+        for start in range(0, nb_rows, chunk_rows):
+            end = start + chunk_rows
+            yield encode_rows(
+                [a[start:end] for a in arrays], [m[start:end] for m in masks], pg_types
+            )
+        yield COPY_TRAILER
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        """Return at most ``size`` bytes of the current chunk, b"" at the end."""
+        while len(self.__chunk) == 0:
+            chunk = next(self.__chunks, None)
+            if chunk is None:
+                return b""
+            self.__chunk = memoryview(chunk)
+        if size < 0:
+            size = len(self.__chunk)
+        data, self.__chunk = self.__chunk[:size], self.__chunk[size:]
+        self.nbytes += len(data)
+        return data.tobytes()
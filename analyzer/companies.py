@@ -1,143 +1,69 @@
-import pandas as pd
-import concurrent.futures
 import numpy as np
-from utils import multi_read_df_from_paths, timer_decorator
+import pandas as pd
 from timescaledb_model import TimescaleStockMarketModel
-from functools import partial
-
 
-map_prefix_to_symbol_nf = {
-    "1rP": lambda x: x[3:].split("_")[0] if len(x) != 15 else np.nan,  # EuroNext Pars
-    "1rA": lambda x: x[3:],  # EuroNext Amsterdam
-    "1rE": lambda x: x[4:],  # EuroNext Paris
-    "FF1": lambda x: x.split("_")[1][0:],  # EuroNext Brussels
+# symbol prefixes whose ticker is a slice of the symbol, the others keep the
+# whole symbol as ticker
+PREFIX_TICKER_SLICES = {
+    "1rP": 3,  # EuroNext Paris, up to the first "_", none for 15 characters
+    "1rA": 3,  # EuroNext Amsterdam
+    "1rE": 4,  # EuroNext Paris
 }
+BRUSSELS_PREFIX = "FF1"  # EuroNext Brussels, after the first "_"
 
 
-def update_ticker_column(
-    df: pd.DataFrame,
-) -> pd.DataFrame:
-    df["ticker"] = df.apply(
-        lambda x: map_prefix_to_symbol_nf.get(x["prefix"], lambda _: x["symbol"])(
-            x["symbol"]
-        ),
-        axis=1,
-    )
-    return df
+def get_tickers(symbols: pd.Series) -> pd.Series:
+    prefixes = symbols.str[:3]
+    tickers = symbols.copy()
+    for prefix, start in PREFIX_TICKER_SLICES.items():
+        is_prefix = prefixes == prefix
+        tickers[is_prefix] = symbols[is_prefix].str[start:]
+    is_paris = prefixes == "1rP"
+    tickers[is_paris] = tickers[is_paris].str.split("_").str[0]
+    tickers[is_paris & (symbols.str.len() == 15)] = np.nan
+    is_brussels = prefixes == BRUSSELS_PREFIX
+    tickers[is_brussels] = symbols[is_brussels].str.split("_").str[1]
+    return tickers
 
 
-def update_mid_column(
-    df: pd.DataFrame,
-    prefix_to_market_id: dict,
-    default_mid: int,
-) -> pd.DataFrame:
-    df["mid"] = df.apply(
-        lambda x: prefix_to_market_id.get(x["prefix"], default_mid),
-        axis=1,
-    )
-    return df
+def get_market_default_mids(db: TimescaleStockMarketModel) -> dict:
+    """Market id of the symbols of each boursorama market without known prefix"""
+    return {
+        "amsterdam": db.eurex_market_id,
+        "compA": db.prefix_to_market_id["1rP"],
+        "compB": db.prefix_to_market_id["1rP"],
+        "peapme": db.prefix_to_market_id["1rP"],
+    }
 
 
-def df_to_companie(
+def df_to_companies(
     df: pd.DataFrame,
     prefix_to_market_id: dict,
+    market_default_mids: dict,
     default_mid: int,
-    is_pea: bool = False,
 ) -> pd.DataFrame:
-    df.reset_index(inplace=True)
-    df_all_days_grouped = df.groupby(["symbol", "name"]).last()
-    df_all_days_grouped["name"] = df_all_days_grouped.index.get_level_values(1)
-    df_companies = df_all_days_grouped.groupby(
-        df_all_days_grouped.index.get_level_values(0)
-    ).last()
-    df_companies = df_companies.reset_index()[["symbol", "name", "date"]]
-    df_companies["prefix"] = df_companies["symbol"].apply(lambda x: x[0:3])
-    df_companies = update_ticker_column(df_companies)
-    df_companies = update_mid_column(
-        df_companies, prefix_to_market_id, default_mid=default_mid
-    )
-    df_companies = df_companies.drop(columns=["prefix"])
-    df_companies["pea"] = is_pea
-    return df_companies
-
-
-def files_to_companies(
-    companies_files_paths: list[str],
-    default_mid: int,
-    is_pea: bool,
-    prefix_to_market_id: dict,
-    num_thread: int,
-):
-    df = multi_read_df_from_paths(companies_files_paths, num_thread=num_thread)
-    companies = df_to_companie(
-        df,
-        prefix_to_market_id=prefix_to_market_id,
-        default_mid=default_mid,
-        is_pea=is_pea,
-    )
-    return companies
-
-
-@timer_decorator
-def update_companies(
-    db: TimescaleStockMarketModel,
-    files_infos_df: pd.DataFrame,
-    num_cpus: int,
-    num_thread: int,
-    keep_first_last=True,
-    existing_symbols=[],
-):
-    print("Updating companies...")
-    if keep_first_last:
-        companies_files_first = files_infos_df.groupby(["market", "date"]).first()
-        companies_files_last = files_infos_df.groupby(["market", "date"]).last()
-        companies_files = pd.concat([companies_files_first, companies_files_last])
-        companies_files.reset_index(inplace=True)
-    else:
-        companies_files = files_infos_df
-        companies_files.reset_index(inplace=True)
-    companies_files_paths = [
-        list(companies_files[companies_files["market"] == "amsterdam"]["path"]),
-        list(companies_files[companies_files["market"] == "compA"]["path"]),
-        list(companies_files[companies_files["market"] == "compB"]["path"]),
-        list(companies_files[companies_files["market"] == "peapme"]["path"]),
-    ]
-    companies_default_mid = [
-        db.eurex_market_id,
-        db.prefix_to_market_id["1rP"],
-        db.prefix_to_market_id["1rP"],
-        db.prefix_to_market_id["1rP"],
-    ]
+    """Companies of the snapshots of ``df``, one per symbol.
 
-    companies_peapme = [False, False, False, True]
-    files_to_companies_partial = partial(
-        files_to_companies,
-        prefix_to_market_id=db.prefix_to_market_id,
-        num_thread=num_thread,
+    The name and market of a symbol are the ones of its last snapshot, ``df``
+    being ordered by date. Symbols of the peapme market are PEA-PME eligible.
+    """
+    symbols = df["symbol"].array
+    codes = np.asarray(symbols.codes)  # type: ignore
+    # last row of every symbol
+    reversed_codes = codes[::-1]
+    present, first_reversed = np.unique(reversed_codes, return_index=True)
+    rows = len(codes) - 1 - first_reversed[present >= 0]
+    last = df.iloc[rows]
+    companies = pd.DataFrame(
+        {
+            "symbol": last["symbol"].astype(str).to_numpy(),
+            "name": last["name"].astype(str).to_numpy(),
+            "market": last["market"].astype(str).to_numpy(),
+        }
     )
-    companies_default_mid = [
-        companies_default_mid[i]
-        for i, c in enumerate(companies_files_paths)
-        if len(c) > 0
-    ]
-    companies_files_paths = [c for c in companies_files_paths if len(c) > 0]
-    companies_list = []
-    with concurrent.futures.ProcessPoolExecutor(max_workers=num_cpus) as executor:
-        companies_list = [
-            r
-            for r in executor.map(
-                files_to_companies_partial, companies_files_paths, companies_default_mid, companies_peapme
-            )
-        ]
-    df_companies = pd.concat(companies_list)
-    df_companies = df_companies[~df_companies["symbol"].isin(existing_symbols)]
-    update_comanies_to_db(db, df_companies)
-
-
-def update_comanies_to_db(db: TimescaleStockMarketModel, df_companies: pd.DataFrame):
-    df_companies.sort_values(by="date", inplace=True)
-    df_companies.drop_duplicates(inplace=True)
-    df_companies.drop_duplicates(subset=["symbol"], keep="last", inplace=True)
-    df_companies.drop("date", axis=1, inplace=True)
-    df_companies.set_index("symbol", inplace=True)
-    db.df_write(df_companies, "companies", commit=True)
+    companies["ticker"] = get_tickers(companies["symbol"])
+    mids = companies["symbol"].str[:3].map(prefix_to_market_id)
+    mids = mids.fillna(companies["market"].map(market_default_mids))
+    companies["mid"] = mids.fillna(default_mid).astype(np.int16)
+    companies["pea"] = companies["market"] == "peapme"
+    return companies.drop(columns=["market"])
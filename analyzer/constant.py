@@ -3,4 +3,54 @@ DATA_PATH = os.getenv('DATA_PATH', os.path.join("..", "data"))
 IS_DOCKER = os.getenv('IS_DOCKER', "False") == "True"
 DATA_PATH_SAMY = os.getenv('DATA_PATH', r"C:\Users\Samy\Desktop\pythonBigData\project\bourse_big_data\data")
 FILES_INFO_PATH = os.path.join(DATA_PATH, 'files_infos.pkl')
+MANIFEST_PATH = os.getenv('MANIFEST_PATH', os.path.join(DATA_PATH, 'manifest.pkl'))
+LOG_LEVEL = os.getenv('LOG_LEVEL', "INFO")
+DB_HOST = os.getenv('DB_HOST', "db" if IS_DOCKER else "localhost")
+DB_PORT = int(os.getenv('DB_PORT', "5432"))
+DECODE_PROCESSES = int(os.getenv('DECODE_PROCESSES', "0"))
 
+PIPELINE_DEPTH = int(os.getenv('PIPELINE_DEPTH', "1"))
+# memory of the ingest workers in MB, 0 for a share of the available memory
+MEMORY_BUDGET = int(os.getenv('MEMORY_BUDGET', "0"))
+
+# opt-in compressed storage of the stocks hypertable, see setup_stocks_storage
+STOCKS_COMPRESSION = os.getenv('STOCKS_COMPRESSION', "False") == "True"
+STOCKS_CHUNK_INTERVAL = os.getenv('STOCKS_CHUNK_INTERVAL', "1 month")
+
+# columnar cache of the snapshots, see snapshot_cache.py
+SNAPSHOT_CACHE = os.getenv('SNAPSHOT_CACHE', "False") == "True"
+CACHE_PATH = os.getenv('CACHE_PATH', os.path.join(DATA_PATH, 'cache'))
+# opt-in drop of the ticks repeating the previous snapshot of their symbol before
+# resampling, the minutes of the repeats get the bar of their last change
+SNAPSHOT_DEDUP = os.getenv('SNAPSHOT_DEDUP', "False") == "True"
+
+# columnar copy of the hypertables for offline analysis, see analytics_store.py
+ANALYTICS_STORE = os.getenv('ANALYTICS_STORE', "False") == "True"
+STORE_PATH = os.getenv('STORE_PATH', os.path.join(DATA_PATH, 'store'))
+
+# searches of TimescaleStockMarketModel.search_companies kept in memory, 0 for none
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', "0"))
+
+# analyze.py watch, seconds between manifest updates and age of a file to read
+WATCH_INTERVAL = float(os.getenv('WATCH_INTERVAL', "2"))
+WATCH_SETTLE = float(os.getenv('WATCH_SETTLE', "1"))
+
+# retry of the quarantined files, see analyze.retry_quarantined
+QUARANTINE_MAX_ATTEMPTS = int(os.getenv('QUARANTINE_MAX_ATTEMPTS', "5"))
+QUARANTINE_BACKOFF = os.getenv('QUARANTINE_BACKOFF', "1 minute")
+QUARANTINE_MAX_BACKOFF = os.getenv('QUARANTINE_MAX_BACKOFF', "1 day")
+
+# ingest metrics, see metrics.py, exported if METRICS_PORT or METRICS_TEXTFILE
+METRICS_PORT = int(os.getenv('METRICS_PORT', "0"))
+METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE', "")
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', "15"))
+METRICS_PATH = os.getenv('METRICS_PATH', os.path.join(DATA_PATH, 'metrics'))
+
+# sampling profiler of the workers, see profiling.py
+PROFILE = os.getenv('PROFILE', "False") == "True"
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', "5"))  # ms
+PROFILE_PATH = os.getenv('PROFILE_PATH', os.path.join(DATA_PATH, 'profiles'))
+
+# database of bench.py ingest, wiped by the benchmark, 0 starts a container
+BENCH_DB_PORT = int(os.getenv('BENCH_DB_PORT', "0"))
+BENCH_DB_IMAGE = os.getenv('BENCH_DB_IMAGE', "timescale/timescaledb:latest-pg16")
@@ -0,0 +1,80 @@
+"""Wake up when snapshot files land below DATA_PATH.
+
+Uses inotify through the C library on Linux and falls back to sleeping
+otherwise. Only the wake up comes from here, the manifest tells which files
+are new.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+from manifest import find_year_dirs
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+EVENTS_SIZE = 64 * 1024
+
+
+class PollingWatch:
+    """Wakes up after every timeout"""
+
+    def wait(self, timeout: float) -> bool:
+        time.sleep(timeout)
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatch:
+    """Wakes up when a file is written or moved into a year directory"""
+
+    def __init__(self, data_path: str):
+        self.data_path = data_path
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched: set[str] = set()
+        self.add_watches()
+
+    def add_watch(self, path: str, mask: int):
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed on {path}")
+        self.watched.add(path)
+
+    def add_watches(self):
+        """Watch the new year directories, and their parents for the next ones"""
+        for year_dir in find_year_dirs(self.data_path):
+            if year_dir not in self.watched:
+                self.add_watch(os.path.dirname(year_dir), IN_CREATE | IN_MOVED_TO)
+                self.add_watch(year_dir, IN_CLOSE_WRITE | IN_MOVED_TO)
+        if self.data_path not in self.watched:
+            self.add_watch(self.data_path, IN_CREATE | IN_MOVED_TO)
+
+    def wait(self, timeout: float) -> bool:
+        """True if files landed within ``timeout`` seconds"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        while True:
+            try:
+                os.read(self.fd, EVENTS_SIZE)
+            except BlockingIOError:
+                break
+        self.add_watches()
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_watch(data_path: str):
+    try:
+        return InotifyWatch(data_path)
+    except (OSError, AttributeError) as e:
+        print(f"No inotify ({e}), polling {data_path}")
+        return PollingWatch()
@@ -0,0 +1,219 @@
+"""Persistent manifest of the boursorama snapshot files.
+
+The manifest is a local index file holding the path, market, timestamp, size
+and mtime of every snapshot, plus the mtime of every year directory. A run
+only lists the year directories whose mtime changed, in parallel with
+``os.scandir``, and only stats the files it does not know yet.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from constant import (
+    CACHE_PATH,
+    DATA_PATH,
+    MANIFEST_PATH,
+    METRICS_PATH,
+    PROFILE_PATH,
+    STORE_PATH,
+)
+
+MANIFEST_VERSION = 1
+MANIFEST_DTYPES = {
+    "path": object,
+    "name": object,
+    "dir": object,
+    "market": object,
+    "year": np.int64,
+    "timestamp": "datetime64[ns]",
+    "size": np.int64,
+    "mtime": np.int64,
+}
+# directories the analyzer writes, by default below DATA_PATH
+OUTPUT_DIRS = {
+    os.path.abspath(p) for p in (CACHE_PATH, STORE_PATH, METRICS_PATH, PROFILE_PATH)
+}
+
+
+def find_year_dirs(data_path: str, skip_dirs=OUTPUT_DIRS) -> dict[str, int]:
+    """Return the mtime of every year directory below ``data_path``.
+
+    Year directories are not listed, so this stays cheap on large trees, and
+    the ``skip_dirs`` are not walked.
+    """
+    year_dirs = {}
+    dirs = [data_path]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if not entry.is_dir() or entry.name[0] == ".":
+                    continue
+                if entry.name.isdigit():
+                    year_dirs[entry.path] = entry.stat().st_mtime_ns
+                elif os.path.abspath(entry.path) not in skip_dirs:
+                    dirs.append(entry.path)
+    return year_dirs
+
+
+def empty_files() -> pd.DataFrame:
+    return pd.DataFrame({c: pd.Series(dtype=t) for c, t in MANIFEST_DTYPES.items()})
+
+
+def stat_entries(year_dir: str, new_entries: list) -> pd.DataFrame:
+    """Manifest rows of the ``os.DirEntry`` of snapshot files of ``year_dir``"""
+    stats = [e.stat() for e in new_entries]
+    markets, timestamps = zip(*(e.name.split(" ", 1) for e in new_entries))
+    timestamps = [t.split(".", 1)[0] for t in timestamps]
+    try:
+        timestamps = pd.to_datetime(timestamps, format="%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        # windows file names
+        timestamps = pd.to_datetime(timestamps, format="%Y-%m-%d %H_%M_%S")
+    return pd.DataFrame(
+        {
+            "path": [e.path for e in new_entries],
+            "name": [e.name for e in new_entries],
+            "dir": year_dir,
+            "market": markets,
+            "year": int(os.path.basename(year_dir)),
+            "timestamp": timestamps,
+            "size": np.fromiter((s.st_size for s in stats), np.int64, len(stats)),
+            "mtime": np.fromiter((s.st_mtime_ns for s in stats), np.int64, len(stats)),
+        }
+    )
+
+
+def scan_year_dir(year_dir: str, known: pd.DataFrame) -> pd.DataFrame:
+    """List ``year_dir`` and stat the files missing from ``known``."""
+    with os.scandir(year_dir) as it:
+        entries = {e.name: e for e in it if e.name[0] != "." and e.is_file()}
+    files = known[known["name"].isin(list(entries))]
+    new_entries = [entries[n] for n in sorted(set(entries).difference(files["name"]))]
+    if len(new_entries) == 0:
+        return files
+    new_files = stat_entries(year_dir, new_entries)
+    if len(files) == 0:
+        return new_files
+    return pd.concat([files, new_files], ignore_index=True)
+
+
+def load_manifest(manifest_path: str) -> dict:
+    try:
+        with open(manifest_path, "rb") as f:
+            manifest = pickle.load(f)
+        if manifest["version"] == MANIFEST_VERSION:
+            return manifest
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+        pass
+    return {"version": MANIFEST_VERSION, "year_dirs": {}, "files": empty_files()}
+
+
+def save_manifest(manifest: dict, manifest_path: str):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, manifest_path)
+
+
+def update_manifest(
+    data_path: str = DATA_PATH,
+    manifest_path: str = MANIFEST_PATH,
+    num_thread=16,
+    verbose: bool = True,
+) -> pd.DataFrame:
+    """Bring the manifest up to date and return its files."""
+    manifest = load_manifest(manifest_path)
+    year_dirs = find_year_dirs(data_path)
+    files: pd.DataFrame = manifest["files"]
+    changed = [
+        d for d, mtime in year_dirs.items() if manifest["year_dirs"].get(d) != mtime
+    ]
+    unchanged = files[files["dir"].isin(set(year_dirs).difference(changed))]
+    known_by_dir = dict(tuple(files[files["dir"].isin(changed)].groupby("dir")))
+    empty = files.iloc[:0]
+    with ThreadPoolExecutor(max_workers=num_thread) as executor:
+        scanned = list(
+            executor.map(
+                lambda d: scan_year_dir(d, known_by_dir.get(d, empty)), changed
+            )
+        )
+    if len(changed) > 0 or len(year_dirs) != len(manifest["year_dirs"]):
+        # empty frames would turn the typed columns into objects
+        frames = [f for f in [unchanged, *scanned] if len(f) > 0]
+        files = pd.concat(frames, ignore_index=True) if frames else files.iloc[:0]
+        manifest["files"] = files
+        manifest["year_dirs"] = year_dirs
+        save_manifest(manifest, manifest_path)
+    if verbose:
+        print(f"Manifest: {len(files)} files, {len(changed)} year directories rescanned")
+    return files
+
+
+def get_manifest_files_infos_df(
+    data_path: str = DATA_PATH, manifest_path: str = MANIFEST_PATH, verbose: bool = True
+) -> pd.DataFrame:
+    """Same frame as ``utils.get_files_infos_df`` with ``size`` and ``mtime``"""
+    return to_files_infos_df(update_manifest(data_path, manifest_path, verbose=verbose))
+
+
+def to_files_infos_df(files: pd.DataFrame) -> pd.DataFrame:
+    """Frame of ``get_manifest_files_infos_df`` of manifest rows"""
+    files_infos_df = files.drop(columns=["dir"])
+    files_infos_df = files_infos_df.set_index("timestamp").sort_index()
+    files_infos_df["year_month"] = files_infos_df.index.to_period("M")  # type: ignore
+    files_infos_df["date"] = files_infos_df.index.date  # type: ignore
+    return files_infos_df
+
+
+class NewFiles:
+    """Snapshot files landing below DATA_PATH, for the watch mode
+
+    The names of the files are kept in memory, starting with the ones of
+    ``files_infos_df``. Only the year directories whose mtime changed are
+    listed and only their new files are stat'ed. The manifest file is left to
+    the batch runs, which rescan these directories.
+    """
+
+    def __init__(self, files_infos_df: pd.DataFrame, data_path: str = DATA_PATH):
+        self.data_path = data_path
+        self.year_dirs: dict[str, int] = {}
+        self.names: dict[str, set] = {}
+        for path in files_infos_df["path"]:
+            year_dir, name = os.path.split(path)
+            self.names.setdefault(year_dir, set()).add(name)
+
+    def get_new_files(self) -> pd.DataFrame:
+        """Files landed since the last call, as ``get_manifest_files_infos_df``"""
+        year_dirs = find_year_dirs(self.data_path)
+        frames = []
+        for year_dir, mtime in year_dirs.items():
+            if self.year_dirs.get(year_dir) == mtime:
+                continue
+            names = self.names.setdefault(year_dir, set())
+            with os.scandir(year_dir) as it:
+                new_entries = [
+                    e for e in it if e.name[0] != "." and e.name not in names and e.is_file()
+                ]
+            if len(new_entries) > 0:
+                new_entries.sort(key=lambda e: e.name)
+                frames.append(stat_entries(year_dir, new_entries))
+                names.update(e.name for e in new_entries)
+        self.year_dirs = year_dirs
+        files = pd.concat(frames, ignore_index=True) if frames else empty_files()
+        return to_files_infos_df(files)
+
+
+def restat(files_infos_df: pd.DataFrame) -> pd.DataFrame:
+    """Current size and mtime of the files, without the vanished ones"""
+    stats = {}
+    for path in files_infos_df["path"]:
+        try:
+            stats[path] = os.stat(path)
+        except FileNotFoundError:
+            pass
+    files_infos_df = files_infos_df[files_infos_df["path"].isin(list(stats))].copy()
+    files_infos_df["size"] = [stats[p].st_size for p in files_infos_df["path"]]
+    files_infos_df["mtime"] = [stats[p].st_mtime_ns for p in files_infos_df["path"]]
+    return files_infos_df
@@ -0,0 +1,220 @@
+"""Ingest metrics in the Prometheus text format.
+
+Every process counts in its own registry, labeled by its worker. Worker
+processes dump it to METRICS_PATH/<pid>.json after each date group. While
+``exporting`` runs, the main process serves its registry and the dumps on
+http://localhost:METRICS_PORT/metrics and rewrites METRICS_TEXTFILE, for the
+node_exporter textfile collector, every METRICS_INTERVAL seconds.
+
+The stages are read (files to snapshots, parse included), parse (snapshots
+to one frame), resample (bars), copy (COPY into the staging tables) and
+commit (merges and commit). Comparing their rate of seconds tells whether
+the ingest waits on the disk, the CPU or Postgres.
+"""
+
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import glob
+import json
+import os
+import threading
+import time
+import pandas as pd
+from constant import METRICS_INTERVAL, METRICS_PATH, METRICS_PORT, METRICS_TEXTFILE
+
+ENABLED = METRICS_PORT > 0 or METRICS_TEXTFILE != ""
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+FAMILIES = {
+    "analyzer_stage_seconds": ("histogram", "Latency of a stage for a date group"),
+    "analyzer_files_total": ("counter", "Snapshot files through a stage"),
+    "analyzer_bytes_total": ("counter", "Bytes of the snapshot files through a stage"),
+    "analyzer_rows_total": ("counter", "Rows out of a stage"),
+    "analyzer_dedup_rows_total": ("counter", "Ticks cut by the dedup"),
+    "analyzer_retries_total": ("counter", "Days read or processed again after a failure"),
+    "analyzer_quarantined_files_total": ("counter", "Files put in quarantine"),
+}
+
+lock = threading.Lock()
+counters: dict = {}  # (name, labels) -> value
+histograms: dict = {}  # (name, labels) -> bucket counts, then sum and count
+default_labels = {"worker": "main"}
+
+
+def set_labels(**labels):
+    """Labels added to every sample of this process"""
+    default_labels.update(labels)
+
+
+def get_key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted({**default_labels, **labels}.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = get_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    key = get_key(name, labels)
+    with lock:
+        histogram = histograms.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+@contextlib.contextmanager
+def timed(stage: str):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_time
+        observe("analyzer_stage_seconds", seconds, stage=stage)
+
+
+def count_files(stage: str, files_df: pd.DataFrame):
+    """Count the files and bytes of a slice of the manifest, per market"""
+    per_market = files_df.groupby("market", observed=True).agg(
+        files=("name", "size"), size=("size", "sum")
+    )
+    for market, row in per_market.iterrows():
+        inc("analyzer_files_total", int(row["files"]), stage=stage, market=market)
+        inc("analyzer_bytes_total", int(row["size"]), stage=stage, market=market)
+
+
+def count_quarantined(stage: str, files_df: pd.DataFrame):
+    for market, value in files_df["market"].value_counts().items():
+        inc("analyzer_quarantined_files_total", int(value), stage=stage, market=market)
+
+
+def count_rows(stage: str, rows: int | pd.Series, market: str = "all"):
+    """Count rows, ``rows`` being a number or the number of rows per market"""
+    if isinstance(rows, pd.Series):
+        for market, value in rows.items():
+            inc("analyzer_rows_total", int(value), stage=stage, market=market)
+    else:
+        inc("analyzer_rows_total", rows, stage=stage, market=market)
+
+
+def count_dedup(stats: dict):
+    """Count the ticks cut, ``stats`` of ``bars.ticks_to_bars``"""
+    for kind in ("repeats", "copies"):
+        inc("analyzer_dedup_rows_total", stats.get(kind, 0), kind=kind)
+
+
+def get_state() -> dict:
+    """Samples of the registry of this process, as JSON lists"""
+    with lock:
+        return {
+            "counters": [[n, labels, v] for (n, labels), v in counters.items()],
+            "histograms": [[n, labels, list(v)] for (n, labels), v in histograms.items()],
+        }
+
+
+def dump(path: str = METRICS_PATH):
+    """Write the registry of this process where the exporter reads it"""
+    if not ENABLED:
+        return
+    state = get_state()
+    os.makedirs(path, exist_ok=True)
+    dump_file = os.path.join(path, f"{os.getpid()}.json")
+    with open(dump_file + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(dump_file + ".tmp", dump_file)
+
+
+def clear_dumps(path: str = METRICS_PATH):
+    for dump_file in glob.glob(os.path.join(path, "*.json")):
+        os.remove(dump_file)
+
+
+def format_labels(labels) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in labels)
+
+
+def render(path: str = METRICS_PATH) -> str:
+    """Registry of this process and the dumps of the workers, as text"""
+    samples: dict = {name: [] for name in FAMILIES}
+    states = [get_state()]
+    for dump_file in glob.glob(os.path.join(path, "*.json")):
+        with contextlib.suppress(OSError, ValueError):
+            with open(dump_file) as f:
+                states.append(json.load(f))
+    for state in states:
+        for name, labels, value in state["counters"]:
+            samples[name].append(f"{name}{{{format_labels(labels)}}} {value}")
+        for name, labels, value in state["histograms"]:
+            cumulated = 0
+            for bound, count in zip(LATENCY_BUCKETS, value[:-2]):
+                cumulated += count
+                bucket_labels = format_labels([*labels, ("le", bound)])
+                samples[name].append(f"{name}_bucket{{{bucket_labels}}} {cumulated}")
+            bucket_labels = format_labels([*labels, ("le", "+Inf")])
+            samples[name].append(f"{name}_bucket{{{bucket_labels}}} {value[-1]}")
+            samples[name].append(f"{name}_sum{{{format_labels(labels)}}} {value[-2]}")
+            samples[name].append(f"{name}_count{{{format_labels(labels)}}} {value[-1]}")
+    lines = []
+    for name, (kind, help) in FAMILIES.items():
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", *samples[name]]
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(textfile: str = METRICS_TEXTFILE):
+    with open(textfile + ".tmp", "w") as f:
+        f.write(render())
+    os.replace(textfile + ".tmp", textfile)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def exporting():
+    """Export the metrics of the ingest while the block runs"""
+    if not ENABLED:
+        yield
+        return
+    clear_dumps()
+    stop = threading.Event()
+    threads = []
+    server = None
+    if METRICS_PORT > 0:
+        server = ThreadingHTTPServer(("", METRICS_PORT), MetricsHandler)
+        threads.append(threading.Thread(target=server.serve_forever, daemon=True))
+        print(f"Metrics on http://localhost:{METRICS_PORT}/metrics")
+    if METRICS_TEXTFILE != "":
+
+        def refresh_textfile():
+            while not stop.wait(METRICS_INTERVAL):
+                write_textfile()
+
+        threads.append(threading.Thread(target=refresh_textfile, daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if METRICS_TEXTFILE != "":
+            write_textfile()
@@ -5,3 +5,17 @@ class FileInfo(TypedDict):
     timestamp: str
     market: str
     path: str
+
+
+class SharedColumn(TypedDict):
+    name: str
+    dtype: str
+    offset: int
+    length: int
+    categories: list | None
+
+
+class SharedFrame(TypedDict):
+    shm_name: str
+    nbytes: int
+    columns: list[SharedColumn]
@@ -17,13 +17,69 @@
     doctest
 '''
 
+import atexit
 import logging
 import logging.handlers
+import multiprocessing.util
+import os
+import queue
+from constant import LOG_LEVEL
 
 INFO = logging.INFO
 DEBUG = logging.DEBUG
 
-log_level = logging.DEBUG  # change this if you want a another default variable
+# change LOG_LEVEL if you want a another default level, DEBUG logs every query
+log_level = logging.getLevelName(LOG_LEVEL)
+
+# Records go through a queue to one listener thread per log file, which
+# writes them. Loggers share the queue handler of their file.
+listeners = {}  # filename -> (QueueHandler, QueueListener)
+stop_pid = None  # process which registered stop_listeners
+
+
+def stop_listeners():
+    """Write the queued records and stop the listener threads"""
+    for _, listener in listeners.values():
+        if listener._thread is not None:
+            listener.stop()
+
+
+def restart_listeners():
+    """Listener threads do not survive a fork, give the child its own ones"""
+    for filename, (qh, listener) in listeners.items():
+        qh.queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(
+            qh.queue, *listener.handlers, respect_handler_level=True
+        )
+        listener.start()
+        listeners[filename] = (qh, listener)
+
+
+def register_stop():
+    """Stop the listeners at the exit of this process, once"""
+    global stop_pid
+    if stop_pid != os.getpid():
+        atexit.register(stop_listeners)
+        # multiprocessing children leave through os._exit, without atexit
+        multiprocessing.util.Finalize(None, stop_listeners, exitpriority=0)
+        stop_pid = os.getpid()
+
+
+def get_queue_handler(filename, level, file_level, formatter):
+    register_stop()
+    if filename not in listeners:
+        fh = logging.handlers.RotatingFileHandler(filename, maxBytes=10*1024*1024, backupCount=3)
+        fh.setLevel(level if file_level is None else file_level)
+        fh.setFormatter(formatter)
+        qh = logging.handlers.QueueHandler(queue.SimpleQueue())
+        listener = logging.handlers.QueueListener(qh.queue, fh, respect_handler_level=True)
+        listener.start()
+        listeners[filename] = (qh, listener)
+    return listeners[filename][0]
+
+
+os.register_at_fork(after_in_child=restart_listeners)
+
 
 def getLogger(name, level=log_level,
               filename=None, file_level=None, show_log_path=False):
@@ -31,18 +87,14 @@ def getLogger(name, level=log_level,
     logger.setLevel(level)
     # create formatter
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    # create file handle if needed
+    # create file handle if needed, once per file and process
     if filename is not None:
         if show_log_path:
             print("Logs of %s go to %s" % (name, filename))
-        fh = logging.handlers.RotatingFileHandler(filename, maxBytes=10*1024*1024, backupCount=3)
-        if file_level is None:
-            fh.setLevel(level)
-        else:
-            fh.setLevel(file_level)
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
-    else:
+        qh = get_queue_handler(filename, level, file_level, formatter)
+        if qh not in logger.handlers:
+            logger.addHandler(qh)
+    elif not any(h.get_name() == "handler of %s" % name for h in logger.handlers):
         # create console handler and set level to debug
         sh = logging.StreamHandler()
         sh.set_name("handler of %s" % name)
@@ -50,5 +102,3 @@ def getLogger(name, level=log_level,
         sh.setFormatter(formatter)
         logger.addHandler(sh)
     return logger
-
-
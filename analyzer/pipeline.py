@@ -0,0 +1,128 @@
+"""Bounded read -> transform -> write pipeline.
+
+Each stage runs in its own thread and the stages are connected by queues of
+``depth`` entries, so the next item is read while the current one is being
+written. At most ``2 * depth + 3`` items are in memory at the same time.
+"""
+
+import queue
+import threading
+from typing import Any, Callable, Iterable
+
+_DONE = object()
+
+
+def max_items_in_flight(depth: int) -> int:
+    """Items held at most by a pipeline of ``depth``: one per stage and the
+    entries of the two queues"""
+    return 2 * depth + 3
+
+
+class StageError:
+    """Result of an item whose stage raised, passed down to ``on_error``."""
+
+    def __init__(self, stage: str, exception: Exception):
+        self.stage = stage
+        self.exception = exception
+
+
+def _put(outbox: queue.Queue, entry, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            outbox.put(entry, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _read_stage(items, read, outbox, stop, errors):
+    iterator = iter(items)
+    try:
+        # not pulling an item the pipeline would drop once stopped
+        while not stop.is_set():
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            try:
+                value = read(item)
+            except Exception as e:
+                value = StageError("read", e)
+            _put(outbox, (item, value), stop)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        _put(outbox, _DONE, stop)
+
+
+def _transform_stage(transform, inbox, outbox, stop):
+    while not stop.is_set():
+        try:
+            entry = inbox.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if entry is _DONE:
+            _put(outbox, _DONE, stop)
+            return
+        item, value = entry
+        if not isinstance(value, StageError):
+            try:
+                value = transform(item, value)
+            except Exception as e:
+                value = StageError("transform", e)
+        _put(outbox, (item, value), stop)
+
+
+def run_pipeline(
+    items: Iterable,
+    read: Callable[[Any], Any],
+    transform: Callable[[Any, Any], Any],
+    write: Callable[[Any, Any], None],
+    on_error: Callable[[Any, StageError], None],
+    depth: int = 1,
+):
+    """Run ``write(item, transform(item, read(item)))`` for every item.
+
+    ``read`` and ``transform`` run in background threads, ``write`` and
+    ``on_error`` run in the calling thread, which should own the database
+    connection. A failing item is given to ``on_error`` and the pipeline
+    moves on to the next one. An error raised by ``items`` ends the pipeline
+    and is raised again once the items read are written.
+    """
+    stop = threading.Event()
+    items_errors: list[Exception] = []
+    read_queue: queue.Queue = queue.Queue(maxsize=depth)
+    write_queue: queue.Queue = queue.Queue(maxsize=depth)
+    threads = [
+        threading.Thread(
+            target=_read_stage,
+            args=(items, read, read_queue, stop, items_errors),
+            daemon=True,
+        ),
+        threading.Thread(
+            target=_transform_stage,
+            args=(transform, read_queue, write_queue, stop),
+            daemon=True,
+        ),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            entry = write_queue.get()
+            if entry is _DONE:
+                break
+            item, value = entry
+            if isinstance(value, StageError):
+                on_error(item, value)
+                continue
+            try:
+                write(item, value)
+            except Exception as e:
+                on_error(item, StageError("write", e))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if len(items_errors) > 0:
+        raise items_errors[0]
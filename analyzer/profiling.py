@@ -0,0 +1,154 @@
+"""Sampling profiler of the date groups of the analyzer workers.
+
+With PROFILE=True a thread of each worker samples, every PROFILE_INTERVAL
+ms, the stacks of the threads running a stage of a date group. Each group
+gets a PROFILE_PATH/<date>_<days>d_<index>.folded file of collapsed stacks,
+rooted at the stage, for flamegraph.pl or speedscope. At the end of the run
+the hot functions of all the groups are printed and kept in summary.txt.
+
+The stages are wrapped only when PROFILE is set, disabled it costs nothing.
+"""
+
+from collections import Counter
+import contextlib
+import glob
+import os
+import sys
+import threading
+import time
+from constant import PROFILE, PROFILE_INTERVAL, PROFILE_PATH
+
+SUMMARY_SIZE = 25
+
+
+def is_wrapper(code) -> bool:
+    return code.co_name == "wrapper" and code.co_filename == __file__
+
+
+def get_frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame) -> str:
+    """Stack of ``frame`` up to the stage, whose wrapper is left out"""
+    names = []
+    while frame is not None and not is_wrapper(frame.f_code):
+        names.append(get_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler:
+    """Samples the threads which run a stage, by date group"""
+
+    def __init__(self, interval: float, path: str):
+        self.interval = interval
+        self.path = path
+        self.lock = threading.Lock()
+        self.stages: dict = {}  # thread id -> (group, stage)
+        self.samples: dict = {}  # group -> Counter of stacks
+        self.thread = None
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, (group, stage) in self.stages.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stack = f"{stage};{collapse(frame)}"
+                        self.samples.setdefault(group, Counter())[stack] += 1
+
+    @contextlib.contextmanager
+    def sampling(self, group: str, stage: str):
+        # threads do not survive a fork, the sampler starts in the worker
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.stages[thread_id] = (group, stage)
+        try:
+            yield
+        finally:
+            with self.lock:
+                del self.stages[thread_id]
+
+    def dump(self, group: str):
+        """Append the samples of a group to its profile file"""
+        with self.lock:
+            samples = self.samples.pop(group, Counter())
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, f"{group}.folded"), "a") as f:
+            for stack, count in samples.items():
+                f.write(f"{stack} {count}\n")
+
+
+sampler = Sampler(PROFILE_INTERVAL / 1000, PROFILE_PATH) if PROFILE else None
+
+
+def get_group_name(item) -> str:
+    index, date_group, _ = item
+    return f"{date_group[0].isoformat()}_{len(date_group)}d_{index}"
+
+
+def profiled(func, stage: str, last: bool = False):
+    """Sample ``func(item, ...)`` under the date group of ``item``
+
+    The profile of the group is written after its ``last`` stage. Returns
+    ``func`` itself when profiling is disabled.
+    """
+    if sampler is None:
+        return func
+
+    def wrapper(item, *args):
+        group = get_group_name(item)
+        try:
+            with sampler.sampling(group, stage):
+                return func(item, *args)
+        finally:
+            if last:
+                sampler.dump(group)
+
+    return wrapper
+
+
+def clear_profiles(path: str = PROFILE_PATH):
+    for profile_file in glob.glob(os.path.join(path, "*.folded")):
+        os.remove(profile_file)
+
+
+def summarize(path: str = PROFILE_PATH, size: int = SUMMARY_SIZE) -> str:
+    """Functions with the most samples, on top of the stack and in it"""
+    own, total = Counter(), Counter()
+    nb_samples = 0
+    stages = Counter()
+    for profile_file in glob.glob(os.path.join(path, "*.folded")):
+        with open(profile_file) as f:
+            for line in f:
+                stack, count = line.rsplit(" ", 1)
+                count = int(count)
+                names = stack.split(";")
+                nb_samples += count
+                stages[names[0]] += count
+                own[names[-1]] += count
+                for name in set(names[1:]):
+                    total[name] += count
+    lines = [f"{nb_samples} samples"]
+    lines += [f"  {count / nb_samples:6.1%}  {stage}" for stage, count in stages.most_common()]
+    lines.append("own time:")
+    lines += [f"  {count / nb_samples:6.1%}  {name}" for name, count in own.most_common(size)]
+    lines.append("total time:")
+    lines += [f"  {count / nb_samples:6.1%}  {name}" for name, count in total.most_common(size)]
+    return "\n".join(lines)
+
+
+def write_summary(path: str = PROFILE_PATH):
+    if len(glob.glob(os.path.join(path, "*.folded"))) == 0:
+        return
+    summary = summarize(path)
+    with open(os.path.join(path, "summary.txt"), "w") as f:
+        f.write(summary + "\n")
+    print(f"Profile of the workers, see {path}\n{summary}")
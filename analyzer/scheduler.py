@@ -0,0 +1,184 @@
+"""Size aware scheduling of date groups between analyzer workers.
+
+The cost of a date is estimated from the manifest: the bytes of its files
+plus a fixed overhead per file, summed over the markets. Dates are packed
+into groups of about the same cost, which are handed out biggest first
+through a queue the workers pull from until it runs dry.
+
+The number of workers and the size of the groups follow a memory budget: a
+worker holds about ``MEMORY_PER_COST`` bytes per byte of cost of the group
+being resampled and ``HELD_MEMORY_PER_COST`` for each other group in its
+pipeline, on top of ``WORKER_BASE_BYTES``. Its decode processes, if any, add
+their own base memory and the shared blocks of the group being read.
+"""
+
+from datetime import date
+import multiprocessing
+import os
+import resource
+import numpy as np
+import pandas as pd
+from pipeline import max_items_in_flight
+
+# unpickling a snapshot costs about as much as reading this many bytes
+FILE_OVERHEAD_BYTES = 64 * 1024
+GROUPS_PER_WORKER = 4
+# resident memory of an idle worker, pandas and the db connection loaded
+WORKER_BASE_BYTES = 150 * 1024**2
+# peak memory of a worker per byte of cost of a group: the snapshots, their
+# concatenation and the sorted copies of the bars kernel
+MEMORY_PER_COST = 4
+# memory per byte of cost of a group waiting in the pipeline, read or resampled
+HELD_MEMORY_PER_COST = 1
+# resident memory of an idle decode process
+DECODE_BASE_BYTES = 100 * 1024**2
+# the snapshots unpickled by the decode processes and their shared blocks
+DECODE_MEMORY_PER_COST = 2
+# share of the available memory used when no budget is given
+DEFAULT_BUDGET_SHARE = 0.7
+CGROUP_LIMIT_FILES = [
+    "/sys/fs/cgroup/memory.max",
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+]
+
+
+def get_date_costs(files_df: pd.DataFrame) -> pd.Series:
+    """Estimated cost of every date of ``files_df``, in bytes"""
+    per_market = files_df.groupby(["date", "market"]).agg(
+        files=("name", "size"), size=("size", "sum")
+    )
+    costs = per_market["size"] + per_market["files"] * FILE_OVERHEAD_BYTES
+    return costs.groupby(level="date").sum()
+
+
+def plan_date_groups(
+    date_costs: pd.Series, group_cost: float
+) -> list[tuple[list[date], int]]:
+    """Pack consecutive dates into groups of about ``group_cost``.
+
+    Returns the groups and their costs, biggest first.
+    """
+    groups, dates, cost = [], [], 0
+    for d, date_cost in date_costs.sort_index().items():
+        if len(dates) > 0 and cost + date_cost > group_cost:
+            groups.append((dates, cost))
+            dates, cost = [], 0
+        dates.append(d)
+        cost += int(date_cost)
+    if len(dates) > 0:
+        groups.append((dates, cost))
+    return sorted(groups, key=lambda g: g[1], reverse=True)
+
+
+def get_available_memory() -> int:
+    """Memory of the container if limited, else the available memory"""
+    for path in CGROUP_LIMIT_FILES:
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports a huge number when unlimited
+        if limit.isdigit() and int(limit) < 2**60:
+            return int(limit)
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = dict(line.split(":", 1) for line in f)
+        return int(meminfo["MemAvailable"].split()[0]) * 1024
+    except (OSError, KeyError):
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def get_memory_budget(budget_mb: int = 0) -> int:
+    """Memory budget of the workers in bytes, ``budget_mb`` if given"""
+    if budget_mb > 0:
+        return budget_mb * 1024**2
+    return int(get_available_memory() * DEFAULT_BUDGET_SHARE)
+
+
+def get_memory_per_cost(depth: int, num_decode_process: int = 0) -> float:
+    """Peak memory of a worker per byte of cost of its groups, with a
+    pipeline of ``depth`` and ``num_decode_process`` decode processes"""
+    held = max_items_in_flight(depth) - 1
+    memory_per_cost = MEMORY_PER_COST + HELD_MEMORY_PER_COST * held
+    if num_decode_process > 0:
+        memory_per_cost += DECODE_MEMORY_PER_COST
+    return memory_per_cost
+
+
+def get_base_memory(num_decode_process: int = 0) -> float:
+    """Memory of an idle worker and of its decode processes"""
+    return WORKER_BASE_BYTES + DECODE_BASE_BYTES * num_decode_process
+
+
+def get_worker_memory(
+    group_cost: float, depth: int, num_decode_process: int = 0
+) -> float:
+    """Estimated peak memory of a worker whose pipeline is full of groups of
+    ``group_cost``"""
+    return get_base_memory(num_decode_process) + group_cost * get_memory_per_cost(
+        depth, num_decode_process
+    )
+
+
+def plan_workers(
+    date_costs: pd.Series,
+    max_workers: int,
+    budget: int,
+    depth: int,
+    num_decode_process: int = 0,
+) -> tuple[int, float]:
+    """Number of workers and group cost whose peak memory fits ``budget``.
+
+    As many workers as the heaviest date allows, since a date cannot be
+    split, then the biggest groups their share of the budget holds, cut so
+    that every worker still gets several groups.
+    """
+    heaviest = float(date_costs.max())
+    heaviest_memory = get_worker_memory(heaviest, depth, num_decode_process)
+    fitting = int(budget // heaviest_memory)
+    if fitting < 1:
+        print(
+            f"Memory budget of {budget / 1e6:.0f} MB too small for the heaviest "
+            f"date, about {heaviest_memory / 1e6:.0f} MB"
+        )
+    num_workers = max(min(max_workers, len(date_costs), fitting), 1)
+    worker_budget = budget / num_workers - get_base_memory(num_decode_process)
+    group_cost = min(
+        max(worker_budget / get_memory_per_cost(depth, num_decode_process), heaviest),
+        float(date_costs.sum()) / (num_workers * GROUPS_PER_WORKER),
+    )
+    return num_workers, group_cost
+
+
+def get_max_rss() -> int:
+    """Peak resident memory of the current process in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_work_queue(
+    date_groups: list[tuple[list[date], int]], num_workers: int
+) -> multiprocessing.Queue:
+    """Queue of (index, date_group, cost) ended by one None per worker"""
+    work_queue = multiprocessing.Queue()
+    for index, (date_group, cost) in enumerate(date_groups, start=1):
+        work_queue.put((index, date_group, cost))
+    for _ in range(num_workers):
+        work_queue.put(None)
+    return work_queue
+
+
+def log_utilization(workers_stats: list[dict]):
+    """Print how long each worker was active compared to the whole run"""
+    start = min(s["start"] for s in workers_stats)
+    duration = max(s["end"] for s in workers_stats) - start
+    for s in sorted(workers_stats, key=lambda s: s["pid"]):
+        active = s["end"] - s["start"]
+        print(
+            f"Worker {s['pid']}: {s['groups']} groups, {s['cost'] / 1e6:.0f} MB, "
+            f"active {active:.1f}s, utilization {active / max(duration, 1e-9):.0%}, "
+            f"peak memory {s['max_rss'] / 1e6:.0f} MB"
+        )
+    actives = np.array([s["end"] - s["start"] for s in workers_stats])
+    print(f"Workers imbalance: {(actives.max() - actives.min()):.1f}s")
+    print(f"Workers peak memory: {sum(s['max_rss'] for s in workers_stats) / 1e6:.0f} MB")
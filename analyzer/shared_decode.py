@@ -0,0 +1,170 @@
+"""Process based decoding of boursorama snapshot files.
+
+Unpickling is mostly GIL bound, so threads barely scale. Here worker
+processes unpickle and normalize chunks of files and hand the columns back
+through shared memory: the consumer only copies flat buffers instead of
+unpickling the DataFrames a second time.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+import time
+from typing import Optional
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+import metrics
+from models import SharedColumn, SharedFrame
+from utils import snapshots_to_df
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_decode_executor(num_process: int) -> ProcessPoolExecutor:
+    """Return the decode pool of this process, created on first use."""
+    global _executor
+    if _executor is None or _executor._max_workers != num_process:  # type: ignore
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = ProcessPoolExecutor(max_workers=num_process)
+    return _executor
+
+
+def shutdown_decode_executor():
+    """Stop the decode pool of this process, if any.
+
+    A pool worker exits by joining its children, so it must stop its decode
+    pool first.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+def df_to_shm(df: pd.DataFrame) -> SharedFrame:
+    """Copy the index and columns of ``df`` into one shared memory block.
+
+    Categorical columns are stored as codes, other non numeric columns are
+    turned into categoricals first. The block is left for the consumer to
+    unlink.
+    """
+    df = df.reset_index()
+    arrays, columns, offset = [], [], 0
+    for name in df.columns:
+        values = df[name]
+        categories = None
+        if values.dtype == object:
+            values = values.astype("category")
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = list(values.cat.categories)
+            array = values.cat.codes.to_numpy()
+        else:
+            array = values.to_numpy()
+        arrays.append(array)
+        columns.append(
+            SharedColumn(
+                name=name,
+                dtype=array.dtype.str,
+                offset=offset,
+                length=len(array),
+                categories=categories,
+            )
+        )
+        offset += -(-array.nbytes // 8) * 8
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for array, column in zip(arrays, columns):
+        np.ndarray(
+            array.shape, dtype=array.dtype, buffer=shm.buf, offset=column["offset"]
+        )[:] = array
+    # the consumer owns the block from now on
+    resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+    shm.close()
+    return SharedFrame(shm_name=shm.name, nbytes=offset, columns=columns)
+
+
+def shm_to_columns(shared_frame: SharedFrame) -> dict:
+    """Copy the columns out of a shared memory block and unlink it."""
+    shm = shared_memory.SharedMemory(name=shared_frame["shm_name"])
+    try:
+        columns = {}
+        for column in shared_frame["columns"]:
+            array = np.frombuffer(
+                shm.buf,
+                dtype=np.dtype(column["dtype"]),
+                count=column["length"],
+                offset=column["offset"],
+            ).copy()
+            if column["categories"] is not None:
+                array = pd.Categorical.from_codes(
+                    array, categories=column["categories"]
+                )
+            columns[column["name"]] = array
+    finally:
+        shm.close()
+        shm.unlink()
+    return columns
+
+
+def decode_files(
+    paths: list[str], timestamps: np.ndarray, markets: np.ndarray
+) -> tuple[SharedFrame, float]:
+    """The decoded files in shared memory, with the seconds spent parsing"""
+    frames = [pd.read_pickle(path) for path in paths]
+    start_time = time.perf_counter()
+    df = snapshots_to_df(frames, timestamps, markets)
+    return df_to_shm(df), time.perf_counter() - start_time
+
+
+def concat_columns(chunks: list[dict]) -> pd.DataFrame:
+    data = {}
+    for name in chunks[0]:
+        arrays = [chunk[name] for chunk in chunks]
+        if isinstance(arrays[0], pd.Categorical):
+            data[name] = union_categoricals(arrays)
+        else:
+            data[name] = np.concatenate(arrays)
+    return pd.DataFrame(data).set_index("date")
+
+
+def process_read_files_df(
+    files_df: pd.DataFrame, num_process: int, files_per_chunk: int = 32
+) -> pd.DataFrame:
+    """Same as ``utils.read_files_df`` but decoding in ``num_process`` processes.
+
+    The parse stage counts the parsing seconds of all the processes.
+    """
+    if len(files_df) == 0:
+        with metrics.timed("parse"):
+            return snapshots_to_df([], [], [])
+    executor = get_decode_executor(num_process)
+    nb_chunks = min(
+        len(files_df),
+        max(num_process, min(num_process * 4, len(files_df) // files_per_chunk)),
+    )
+    chunks_indexes = np.array_split(np.arange(len(files_df)), nb_chunks)
+    paths = files_df["path"].to_numpy()
+    timestamps = files_df.index.to_numpy()
+    markets = files_df["market"].to_numpy()
+    futures = [
+        executor.submit(
+            decode_files, list(paths[indexes]), timestamps[indexes], markets[indexes]
+        )
+        for indexes in chunks_indexes
+    ]
+    # unlink every block even if one of the chunks failed
+    chunks, error, parse_seconds = [], None, 0.0
+    for future in futures:
+        try:
+            shared_frame, seconds = future.result()
+            chunks.append(shm_to_columns(shared_frame))
+            parse_seconds += seconds
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+    start_time = time.perf_counter()
+    df = concat_columns(chunks)
+    parse_seconds += time.perf_counter() - start_time
+    metrics.observe("analyzer_stage_seconds", parse_seconds, stage="parse")
+    return df
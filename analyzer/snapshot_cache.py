@@ -0,0 +1,174 @@
+"""Columnar cache of the normalized boursorama snapshots.
+
+Each market-day is converted once into a Parquet file holding the columns of
+``utils.read_files_df``, partitioned like
+
+  CACHE_PATH/market=<market>/year=<year>/date=<date>/snapshots.parquet
+
+The names of the source files are kept in the file metadata. Reads are memory
+mapped, only load the requested columns, and fall back to the pickles for the
+files a cache file does not cover.
+
+  python3 snapshot_cache.py [num_process]
+"""
+
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date
+import json
+import multiprocessing
+import os
+import sys
+from typing import Optional
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from constant import CACHE_PATH, SNAPSHOT_CACHE
+import metrics
+from shared_decode import concat_columns
+from utils import read_files_df
+
+SOURCE_FILES_KEY = b"source_files"
+VERSION_KEY = b"cache_version"
+# bumped when the columns change, older cache files are converted again
+CACHE_VERSION = b"2"
+
+
+def get_cache_file(cache_path: str, market: str, day: date) -> str:
+    return os.path.join(
+        cache_path,
+        f"market={market}",
+        f"year={day.year}",
+        f"date={day.isoformat()}",
+        "snapshots.parquet",
+    )
+
+
+def get_cached_names(path: str) -> set[str]:
+    """Names of the snapshot files held by a cache file, empty if missing"""
+    try:
+        metadata = pq.read_schema(path, memory_map=True).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return set()
+    if metadata.get(VERSION_KEY) != CACHE_VERSION:
+        return set()
+    return set(json.loads(metadata.get(SOURCE_FILES_KEY, b"[]")))
+
+
+def write_cache_file(df: pd.DataFrame, names, path: str):
+    table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[SOURCE_FILES_KEY] = json.dumps(sorted(names)).encode()
+    metadata[VERSION_KEY] = CACHE_VERSION
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    pq.write_table(
+        table.replace_schema_metadata(metadata), tmp_path, compression="zstd"
+    )
+    os.replace(tmp_path, path)
+
+
+def convert_market_day(files_df: pd.DataFrame, path: str, num_thread: int) -> int:
+    """Convert the readable files of a market-day, the others are left to the
+    ingest which quarantines them"""
+    errors: dict = {}
+    try:
+        df = read_files_df(files_df, num_thread, errors=errors)
+    except ValueError:
+        return 0
+    names = files_df["name"][~files_df["name"].isin(list(errors))]
+    write_cache_file(df, names, path)
+    return len(names)
+
+
+def update_cache(
+    files_infos_df: pd.DataFrame,
+    num_process: int,
+    num_thread: int = 4,
+    cache_path: str = CACHE_PATH,
+):
+    """Convert the market-days whose cache file misses some of their files"""
+    todo = []
+    for (market, day), files_df in files_infos_df.groupby(["market", "date"]):
+        path = get_cache_file(cache_path, market, day)  # type: ignore
+        if not set(files_df["name"]) <= get_cached_names(path):
+            todo.append((files_df, path))
+    nb_files = 0
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=num_process) as executor:
+            futures = [
+                executor.submit(convert_market_day, files_df, path, num_thread)
+                for files_df, path in todo
+            ]
+            nb_files = sum(f.result() for f in futures)
+    print(f"Snapshot cache: {len(todo)} market-days converted, {nb_files} files")
+
+
+def frame_to_columns(df: pd.DataFrame) -> dict:
+    """Arrays of the columns of ``df``, in the format of ``concat_columns``"""
+    return {
+        c: df[c].array if isinstance(df[c].dtype, pd.CategoricalDtype) else df[c].to_numpy()
+        for c in df.columns
+    }
+
+
+def read_cache_file(
+    path: str, columns: Optional[list[str]] = None, timestamps=None
+) -> dict:
+    """Columns of a cache file, restricted to the snapshots at ``timestamps``"""
+    if columns is not None:
+        columns = ["date", *columns]
+    table = pq.read_table(path, columns=columns, memory_map=True)
+    if timestamps is not None:
+        table = table.filter(
+            pc.is_in(table["date"], value_set=pa.array(timestamps, table["date"].type))
+        )
+    return frame_to_columns(table.to_pandas())
+
+
+def read_snapshots(
+    files_df: pd.DataFrame,
+    num_thread: int,
+    columns: Optional[list[str]] = None,
+    cache_path: Optional[str] = CACHE_PATH if SNAPSHOT_CACHE else None,
+) -> pd.DataFrame:
+    """``utils.read_files_df`` through the cache, keeping only ``columns``
+
+    Market-days covered by their cache file are read from it, the others from
+    the pickles. Rows are ordered by date. Turning the cached columns into the
+    frame is timed as the parse stage.
+    """
+    reads, missing = [], []
+    for (market, day), market_day_df in files_df.groupby(["market", "date"]):
+        names = set(market_day_df["name"])
+        if cache_path is not None:
+            path = get_cache_file(cache_path, market, day)  # type: ignore
+            cached_names = get_cached_names(path)
+            if names <= cached_names:
+                timestamps = market_day_df.index.to_numpy()
+                reads.append((path, timestamps if names != cached_names else None))
+                continue
+        missing.append(market_day_df)
+    chunks = []
+    if len(missing) > 0:
+        df = read_files_df(pd.concat(missing).sort_index(), num_thread)
+        if columns is not None:
+            df = df[columns]
+        chunks.append(frame_to_columns(df.reset_index()))
+    if len(reads) > 0:
+        with ThreadPoolExecutor(max_workers=num_thread) as executor:
+            chunks.extend(
+                executor.map(lambda r: read_cache_file(r[0], columns, r[1]), reads)
+            )
+    # the pickles are parsed by read_files_df
+    parse = metrics.timed("parse") if len(reads) > 0 else contextlib.nullcontext()
+    with parse:
+        return concat_columns(chunks).sort_index(kind="stable")
+
+
+if __name__ == "__main__":
+    from manifest import get_manifest_files_infos_df
+
+    num_process = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+    update_cache(get_manifest_files_infos_df(), num_process)
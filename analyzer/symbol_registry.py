@@ -0,0 +1,46 @@
+"""Company ids of the boursorama symbols, shared by the ingest workers.
+
+Every worker process keeps the ids it knows in memory, the companies table
+is the registry they share. The symbols a worker has not seen yet are
+registered in one batch per date group, which reuses the ids other workers
+gave them, so a new listing costs one insert instead of a failed group.
+"""
+
+import numpy as np
+import pandas as pd
+from bars import get_cids_by_code
+from timescaledb_model import TimescaleStockMarketModel
+
+
+class SymbolRegistry:
+    """Symbol to company id mapping of a worker, completed on the fly."""
+
+    def __init__(self, symbol_to_companies: dict):
+        self.symbol_to_companies = dict(symbol_to_companies)
+        self.nb_registered = 0
+
+    def __len__(self):
+        return len(self.symbol_to_companies)
+
+    def get_unknown_symbols(self, symbols: pd.Index) -> pd.Index:
+        return symbols[~symbols.isin(list(self.symbol_to_companies))]
+
+    def register(
+        self, db: TimescaleStockMarketModel, df_companies: pd.DataFrame
+    ) -> int:
+        """Give an id to the symbols of ``df_companies``, inserting the new ones
+
+        Returns the number of companies this call inserted.
+        """
+        unknown = self.get_unknown_symbols(pd.Index(df_companies["symbol"]))
+        df_companies = df_companies[df_companies["symbol"].isin(unknown)]
+        if len(df_companies) == 0:
+            return 0
+        ids, inserted = db.register_companies(df_companies)
+        # dict updates are atomic, the transform thread may read meanwhile
+        self.symbol_to_companies.update(ids)
+        self.nb_registered += inserted
+        return inserted
+
+    def get_cids_by_code(self, symbols: pd.Index) -> np.ndarray:
+        return get_cids_by_code(symbols, self.symbol_to_companies)
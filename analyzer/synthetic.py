@@ -0,0 +1,180 @@
+"""Synthetic boursorama snapshots, for benchmarks and tests of the analyzer.
+
+Files are written like the boursorama tar, one pickle per market and
+snapshot in DATA_PATH/<year>/:
+
+  <market> <YYYY-MM-DD HH:MM:SS.ffffff>.bz2
+
+A scale of 1 is SCALE_DAYS trading days of FILES_PER_MARKET snapshots of the
+4 markets, bigger scales cover more days. Days already written are skipped.
+As in the real data, some symbols of compA and compB are listed on peapme
+too, with the same values.
+
+  python3 synthetic.py <data_path> [scale] [first_day]
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+MARKETS_NB_SYMBOLS = {"amsterdam": 900, "compA": 150, "compB": 200, "peapme": 450}
+# symbol prefixes of the euronext markets and their share of the symbols
+MARKET_PREFIXES = {
+    "amsterdam": {"1rA": 1.0},
+    "compA": {"1rP": 0.85, "1rE": 0.05, "FF11_": 0.1},
+    "compB": {"1rP": 0.85, "1rE": 0.05, "FF11_": 0.1},
+    "peapme": {"1rP": 0.95, "FF11_": 0.05},
+}
+# code of the symbols of each market
+MARKET_CODES = {"amsterdam": "AM", "compA": "CA", "compB": "CB", "peapme": "PM"}
+# every PEAPME_SHARED_EVERY-th symbol of these markets is listed on peapme too
+PEAPME_SOURCES = ["compA", "compB"]
+PEAPME_SHARED_EVERY = 5
+SCALE_DAYS = 20
+FILES_PER_MARKET = 60
+FIRST_DAY = "2021-03-01"
+# a new symbol is listed on every market every LISTING_DAYS days
+LISTING_DAYS = 10
+
+
+def format_last(prices: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """Format prices like boursorama does: numbers, ``(c)`` suffixes, spaces."""
+    last = prices.astype(object)
+    suffixed = rng.random(len(prices)) < 0.3
+    last[suffixed] = [f"{p:.3f}(c)" for p in prices[suffixed]]
+    spaced = prices >= 1000
+    last[spaced] = [f"{int(p) // 1000} {p % 1000:07.3f}" for p in prices[spaced]]
+    return last
+
+
+def get_symbols(market: str, nb_symbols: int) -> list[str]:
+    """Symbols of a market, the same ones whatever the number listed"""
+    prefixes = list(MARKET_PREFIXES[market])
+    shares = list(MARKET_PREFIXES[market].values())
+    # the prefix of the i-th symbol does not depend on nb_symbols
+    code = MARKET_CODES[market]
+    draws = np.random.default_rng([ord(c) for c in code]).random(nb_symbols)
+    indexes = np.searchsorted(np.cumsum(shares), draws * sum(shares))
+    return [
+        f"{prefixes[p]}{code}{i:05d}" for i, p in zip(range(nb_symbols), indexes)
+    ]
+
+
+def get_peapme_shared(nb_listings: int = 0) -> dict[str, np.ndarray]:
+    """Indexes of the symbols of each source market also listed on peapme"""
+    return {
+        market: np.arange(0, MARKETS_NB_SYMBOLS[market] + nb_listings, PEAPME_SHARED_EVERY)
+        for market in PEAPME_SOURCES
+    }
+
+
+def make_synthetic_day(
+    data_path: str,
+    day: str = "2021-03-02",
+    files_per_market: int = 100,
+    extension: str = "bz2",
+    seed=0,
+    nb_listings: int = 0,
+):
+    """Write one day of snapshot files per market in the boursorama layout.
+
+    Prices follow a random walk where most symbols do not trade between two
+    snapshots, as in the real data. ``nb_listings`` symbols are added to each
+    market. The symbols peapme shares with compA and compB repeat the values
+    of their market's snapshot taken just before.
+    """
+    rng = np.random.default_rng([seed, pd.Timestamp(day).toordinal()])
+    year_path = os.path.join(data_path, day[:4])
+    os.makedirs(year_path, exist_ok=True)
+    timestamps = pd.date_range(f"{day} 09:00", f"{day} 17:30", periods=files_per_market)
+    shared = get_peapme_shared(nb_listings)
+    markets = {}
+    for market, nb_symbols in MARKETS_NB_SYMBOLS.items():
+        nb_symbols += nb_listings
+        if market == "peapme":
+            nb_symbols -= sum(len(indexes) for indexes in shared.values())
+        symbols = np.array(get_symbols(market, nb_symbols), dtype=object)
+        prices = np.round(rng.lognormal(3, 1.5, nb_symbols), 3)
+        markets[market] = {
+            "symbol": symbols,
+            "name": np.array([f"Company {s}" for s in symbols], dtype=object),
+            "last": format_last(prices, rng),
+            "volume": np.zeros(nb_symbols, dtype=np.int64),
+            "prices": prices,
+        }
+    for timestamp in timestamps:
+        for offset, (market, snapshot) in enumerate(markets.items()):
+            prices = snapshot["prices"]
+            traded = rng.random(len(prices)) < 0.2
+            prices[traded] = np.round(
+                prices[traded] * rng.normal(1, 0.002, traded.sum()), 3
+            )
+            snapshot["volume"][traded] += rng.integers(1, 1000, traded.sum())
+            snapshot["last"][traded] = format_last(prices[traded], rng)
+            columns = ["symbol", "name", "last", "volume"]
+            df = pd.DataFrame({c: snapshot[c] for c in columns})
+            if market == "peapme":
+                df = pd.concat(
+                    [df]
+                    + [
+                        pd.DataFrame({c: markets[m][c][indexes] for c in columns})
+                        for m, indexes in shared.items()
+                    ],
+                    ignore_index=True,
+                )
+            taken = timestamp + pd.Timedelta(seconds=offset)
+            name = f"{market} {taken:%Y-%m-%d %H:%M:%S.%f}.{extension}"
+            df.to_pickle(os.path.join(year_path, name))
+
+
+def get_scale_days(scale: int, first_day: str = FIRST_DAY) -> pd.DatetimeIndex:
+    return pd.bdate_range(first_day, periods=scale * SCALE_DAYS)
+
+
+def is_day_written(data_path: str, day: pd.Timestamp) -> bool:
+    """True if the last snapshot of the day is there, days are written in order"""
+    last = pd.Timestamp(f"{day:%Y-%m-%d} 17:30") + pd.Timedelta(
+        seconds=len(MARKETS_NB_SYMBOLS) - 1
+    )
+    market = list(MARKETS_NB_SYMBOLS)[-1]
+    name = f"{market} {last:%Y-%m-%d %H:%M:%S.%f}.bz2"
+    return os.path.exists(os.path.join(data_path, str(day.year), name))
+
+
+def write_synthetic_data(
+    data_path: str,
+    scale: int = 1,
+    first_day: str = FIRST_DAY,
+    num_process: int = multiprocessing.cpu_count(),
+) -> int:
+    """Write the days of a scale missing in ``data_path``, returns their number"""
+    days = get_scale_days(scale, first_day)
+    todo = [
+        (index, day)
+        for index, day in enumerate(days)
+        if not is_day_written(data_path, day)
+    ]
+    with ProcessPoolExecutor(max_workers=num_process) as executor:
+        futures = [
+            executor.submit(
+                make_synthetic_day,
+                data_path,
+                f"{day:%Y-%m-%d}",
+                FILES_PER_MARKET,
+                nb_listings=index // LISTING_DAYS,
+            )
+            for index, day in todo
+        ]
+        for future in futures:
+            future.result()
+    return len(todo)
+
+
+if __name__ == "__main__":
+    scale = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    first_day = sys.argv[3] if len(sys.argv) > 3 else FIRST_DAY
+    nb_days = write_synthetic_data(sys.argv[1], scale, first_day)
+    print(f"{nb_days} days written, {len(get_scale_days(scale, first_day))} days")
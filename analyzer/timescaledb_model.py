@@ -3,7 +3,14 @@
 # TimeScaleDB
 # pipenv install sqlalchemy-timescaledb
 
-from constant import DATA_PATH, IS_DOCKER
+from constant import (
+    DATA_PATH,
+    IS_DOCKER,
+    SEARCH_CACHE_SIZE,
+    STOCKS_CHUNK_INTERVAL,
+    STOCKS_COMPRESSION,
+)
+from collections import OrderedDict
 import psycopg2
 from io import StringIO
 import pandas as pd
@@ -12,6 +19,57 @@ import os
 import time
 import csv
 import mylogging
+from binary_copy import PG_TYPES, BinaryCopyStream, to_copy_array
+
+# unique keys used by merge_staged
+MERGE_KEYS = {
+    "stocks": ["cid", "date"],
+    "daystocks": ["cid", "date"],
+    "file_done": ["name"],
+}
+# columns of the staging tables which do not stage all the columns
+STAGED_COLUMNS = {"file_done": "name"}
+
+# continuous aggregates: name -> (source, bucket), in creation and refresh
+# order since a rollup can be built on a previous one
+ROLLUPS = {
+    "stocks_5m": ("stocks", "5 minutes"),
+    "stocks_1h": ("stocks_5m", "1 hour"),
+    "daystocks_1w": ("daystocks", "1 week"),
+    "daystocks_1mo": ("daystocks", "1 month"),
+}
+
+# columns of the company search, see search_companies
+SEARCH_COLUMNS = ["name", "symbol", "ticker", "isin"]
+# lowercase text of the search columns, indexed by trigrams
+SEARCH_TEXT = (
+    "lower(" + " || ' ' || ".join(f"coalesce({c}, '')" for c in SEARCH_COLUMNS) + ")"
+)
+
+
+def escape_like(text: str) -> str:
+    """``text`` matched literally in a LIKE pattern"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def rollup_query(source: str, bucket: str) -> str:
+    """OHLC query of a continuous aggregate of ``source``
+
+    stocks holds minute means and a cumulated day volume, the other sources
+    are OHLC rows, daystocks holding the volume of the day. The volume of
+    the rollups of stocks stays the cumulated day volume at the end of the
+    bucket, the volume of a bucket being its difference with the previous
+    bucket of the day, as window functions cannot be aggregated.
+    """
+    if source == "stocks":
+        open_, high, low, close = "value", "value", "value", "value"
+    else:
+        open_, high, low, close = "open", "high", "low", "close"
+    volume = "sum(volume)" if source == "daystocks" else "last(volume, date)"
+    return f"""SELECT time_bucket('{bucket}', date) AS date, cid,
+        first({open_}, date) AS open, max({high}) AS high, min({low}) AS low,
+        last({close}, date) AS close, {volume} AS volume
+        FROM {source} GROUP BY time_bucket('{bucket}', date), cid"""
 
 
 class TimescaleStockMarketModel:
@@ -58,6 +116,10 @@ class TimescaleStockMarketModel:
         self.__engine = sqlalchemy.create_engine(
             f"timescaledb://{self.__user}:{self.__password}@{self.__host}:{self.__port}/{self.__database}"
         )
+        self.__tables_types = {}  # table -> {column: binary COPY type}
+        self.__timezone = None
+        self.__trigram_search = None  # pg_trgm installed, see search_companies
+        self.__search_cache = OrderedDict()  # (query, k, min_score) -> matches
         self.__nf_cid = {}  # cid from netfonds symbol
         self.__boursorama_cid = {}  # cid from netfonds symbol
         self.logger.info(
@@ -75,11 +137,12 @@ class TimescaleStockMarketModel:
             "FF1": "e_bruxelle",
         }  # prefix to alias
         self.__prefixes = ["1rP", "1rA", "1rE", "FF1"]
+        market_ids = dict(self.raw_query("SELECT alias, id FROM markets"))
         self.prefix_to_market_id = {
-            prefix: self.get_market_id_from_alias(self.__prefix_to_alias[prefix])
+            prefix: market_ids[self.__prefix_to_alias[prefix]]
             for prefix in self.__prefixes
         }
-        self.eurex_market_id = self.get_market_id_from_alias("eurex")
+        self.eurex_market_id = market_ids["eurex"]
 
     def connect_to_database(self, retry_limit=5, retry_delay=1):
         retry = retry_limit
@@ -89,6 +152,7 @@ class TimescaleStockMarketModel:
                     database=self.__database,
                     user=self.__user,
                     host=self.__host,
+                    port=self.__port,
                     password=self.__password,
                 )
                 return connection
@@ -166,17 +230,47 @@ class TimescaleStockMarketModel:
             print(f"Error dropping hypertable: {e}")
             self.connection.rollback()  # Rollback the current transaction
 
-    def _create_index(self, table_name, index_name, columns, commit=False):
+    def _create_index(
+        self, table_name, index_name, columns, unique=False, commit=False
+    ):
         """Create an index in the database."""
         cursor = self.connection.cursor()
+        unique_sql = "UNIQUE " if unique else ""
         try:
-            cursor.execute(f"CREATE INDEX {index_name} ON {table_name} ({columns});")
+            cursor.execute(
+                f"CREATE {unique_sql}INDEX {index_name} ON {table_name} ({columns});"
+            )
             if commit:
                 self.connection.commit()
         except Exception as e:
             print(f"Error creating index: {e}")
             self.connection.rollback()  # Rollback the current transaction
 
+    def _create_continuous_aggregate(self, view_name, query, commit=False):
+        """Create a continuous aggregate, materialized by the next refresh."""
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(
+                f"CREATE MATERIALIZED VIEW {view_name} "
+                f"WITH (timescaledb.continuous) AS {query} WITH NO DATA;"
+            )
+            if commit:
+                self.connection.commit()
+        except Exception as e:
+            print(f"Error creating continuous aggregate: {e}")
+            self.connection.rollback()  # Rollback the current transaction
+
+    def _drop_continuous_aggregate(self, view_name, commit=False):
+        """Drop a continuous aggregate from the database."""
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view_name} CASCADE;")
+            if commit:
+                self.connection.commit()
+        except Exception as e:
+            print(f"Error dropping continuous aggregate: {e}")
+            self.connection.rollback()  # Rollback the current transaction
+
     def _drop_index(self, index_name, commit=False):
         """Drop an index from the database."""
         cursor = self.connection.cursor()
@@ -256,7 +350,8 @@ class TimescaleStockMarketModel:
                   close FLOAT4,
                   high FLOAT4,
                   low FLOAT4,
-                  volume INT
+                  volume INT,
+                  nb INT
                 );"""
             )
             cursor.execute(
@@ -267,7 +362,8 @@ class TimescaleStockMarketModel:
             )
             cursor.execute(
                 """CREATE TABLE file_done (
-                  name VARCHAR PRIMARY KEY
+                  name VARCHAR PRIMARY KEY,
+                  done_at TIMESTAMPTZ NOT NULL DEFAULT now()
                 );"""
             )
             cursor.execute(
@@ -323,7 +419,7 @@ class TimescaleStockMarketModel:
             )
 
         except Exception as e:
-            self.logger.exception("SQL error: %s" % e)
+            self.logger.exception("SQL error: %s", e)
         self.connection.commit()
 
     def _setup_database(self):
@@ -347,20 +443,18 @@ class TimescaleStockMarketModel:
             )
             self._create_table(
                 "daystocks",
-                "date TIMESTAMPTZ, cid SMALLINT, open FLOAT4, close FLOAT4, high FLOAT4, low FLOAT4, volume INT8, mean FLOAT4, std FLOAT4",
+                "date TIMESTAMPTZ, cid SMALLINT, open FLOAT4, close FLOAT4, high FLOAT4, low FLOAT4, volume INT8, mean FLOAT4, std FLOAT4, nb INT, open_date TIMESTAMPTZ, close_date TIMESTAMPTZ",
+            )
+            self._create_table(
+                "file_done",
+                "name VARCHAR PRIMARY KEY, done_at TIMESTAMPTZ NOT NULL DEFAULT now()",
             )
-            self._create_table("file_done", "name VARCHAR PRIMARY KEY")
             self._create_table("tags", "name VARCHAR PRIMARY KEY, value VARCHAR")
-            self._create_table("error_dates", "date TIMESTAMPTZ")
 
             # Create hypertables
             self._create_hypertable("stocks", "date")
             self._create_hypertable("daystocks", "date")
 
-            # Create indexes
-            self._create_index("stocks", "idx_cid_stocks", "cid, date DESC")
-            self._create_index("daystocks", "idx_cid_daystocks", "cid, date DESC")
-
             # Insert initial market data
             initial_markets_data = [
                 (1, "NYSE Euronext", "euronx"),
@@ -380,11 +474,53 @@ class TimescaleStockMarketModel:
             ]
             self._insert_data("markets", initial_markets_data)
 
+            # Create rollups, each in its own transaction so that a missing
+            # TimescaleDB feature does not undo the tables
+            self.connection.commit()
+            for view_name, (source, bucket) in ROLLUPS.items():
+                self._create_continuous_aggregate(
+                    view_name, rollup_query(source, bucket), commit=True
+                )
+            if STOCKS_COMPRESSION:
+                self.setup_stocks_storage()
+            # files which failed to be ingested, see quarantine_files
+            self._create_table(
+                "quarantine",
+                "name VARCHAR PRIMARY KEY, date TIMESTAMPTZ, stage VARCHAR, reason VARCHAR, attempts INT, last_attempt TIMESTAMPTZ",
+                commit=True,
+            )
+            # companies are registered by the ingest workers on their symbol
+            self._create_index(
+                "companies", "idx_symbol_companies", "symbol", unique=True, commit=True
+            )
+            # tick count of the days, missing from the older databases
+            self.execute("ALTER TABLE daystocks ADD COLUMN IF NOT EXISTS nb INT", commit=True)
+            # time of the open and close ticks, to complete the days in any order
+            self.execute(
+                "ALTER TABLE daystocks ADD COLUMN IF NOT EXISTS open_date TIMESTAMPTZ, "
+                "ADD COLUMN IF NOT EXISTS close_date TIMESTAMPTZ",
+                commit=True,
+            )
+            # ingest time of the files, the watermark of the analytics store
+            self.execute(
+                "ALTER TABLE file_done ADD COLUMN IF NOT EXISTS "
+                "done_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+                commit=True,
+            )
+            self.execute(
+                "CREATE INDEX IF NOT EXISTS idx_done_at_file_done ON file_done (done_at)",
+                commit=True,
+            )
+            self.setup_unique_keys()
+            self.setup_company_search()
+
         except Exception as e:
-            self.logger.exception("SQL error: %s" % e)
+            self.logger.exception("SQL error: %s", e)
         self.connection.commit()
 
     def clean_database(self):
+        for view_name in reversed(ROLLUPS):
+            self._drop_continuous_aggregate(view_name)
         self._drop_table("markets")
         self._drop_table("companies")
         self._drop_table("stocks")
@@ -392,6 +528,7 @@ class TimescaleStockMarketModel:
         self._drop_table("file_done")
         self._drop_table("tags")
         self._drop_table("error_dates")
+        self._drop_table("quarantine")
 
         self._drop_sequence("market_id_seq")
         self._drop_sequence("company_id_seq")
@@ -405,10 +542,9 @@ class TimescaleStockMarketModel:
     def execute(self, query, args=None, cursor=None, commit=False):
         """Send a Postgres SQL command. No return"""
         if args is None:
-            pretty = query
+            self.logger.debug("SQL: QUERY: %s", query)
         else:
-            pretty = "%s %% %r" % (query, args)
-        self.logger.debug("SQL: QUERY: %s" % pretty)
+            self.logger.debug("SQL: QUERY: %s %% %r", query, args)
         if cursor is None:
             cursor = self.connection.cursor()
         cursor.execute(query, args)
@@ -512,15 +648,274 @@ class TimescaleStockMarketModel:
         if commit:
             self.commit()
 
+    def get_table_types(self, table: str) -> dict:
+        """Return the binary COPY type of every column of ``table`` (cached)
+
+        The table is found as the queries find it, so a temporary stage_ table
+        and tables of the same name in other schemas are not mixed up.
+        """
+        if table not in self.__tables_types:
+            rows = self.raw_query(
+                "SELECT column_name, data_type FROM information_schema.columns "
+                "WHERE (table_schema, table_name) = ("
+                "  SELECT n.nspname, c.relname FROM pg_class c"
+                "  JOIN pg_namespace n ON n.oid = c.relnamespace"
+                "  WHERE c.oid = to_regclass(%s)"
+                ") ORDER BY ordinal_position",
+                (table,),
+            )
+            self.__tables_types[table] = {name: PG_TYPES[t] for name, t in rows}
+        return self.__tables_types[table]
+
+    def get_timezone(self) -> str:
+        if self.__timezone is None:
+            self.__timezone = self.raw_query("SHOW timezone")[0][0]
+        return self.__timezone
+
+    def copy_write(
+        self,
+        df: pd.DataFrame | pd.Series,
+        table: str,
+        index=True,
+        commit=False,
+        chunk_rows=100_000,
+    ):
+        """Write a Pandas dataframe with a binary COPY on the model connection
+
+        Unlike df_write, the rows are part of the current transaction. The
+        payload is encoded from the NumPy arrays of the columns, ``chunk_rows``
+        rows at a time.
+
+        :param index: write the index levels as columns, as df_write does
+        :param commit: do a commit after writing
+        """
+        if isinstance(df, pd.Series):
+            df = df.to_frame()
+        if index:
+            df = df.reset_index()
+        table_types = self.get_table_types(table)
+        columns = [str(c) for c in df.columns]
+        pg_types = [table_types[c] for c in columns]
+        arrays, masks = [], []
+        for column, pg_type in zip(columns, pg_types):
+            array, mask = to_copy_array(
+                df[column].to_numpy(), pg_type, timezone=self.get_timezone()
+            )
+            arrays.append(array)
+            masks.append(mask)
+        stream = BinaryCopyStream(arrays, masks, pg_types, chunk_rows=chunk_rows)
+        sql = "COPY {} ({}) FROM STDIN WITH (FORMAT binary)".format(
+            table, ", ".join('"{}"'.format(c) for c in columns)
+        )
+        self.logger.debug("copy_write: %s rows into %s", len(df), table)
+        with self.connection.cursor() as cursor:
+            cursor.copy_expert(sql, stream, size=1 << 20)
+        if commit:
+            self.commit()
+
+    def create_staging_tables(
+        self, tables=("stocks", "daystocks", "file_done", "companies", "quarantine")
+    ):
+        """Create the session staging table stage_<table> of each table
+
+        They are temporary tables: unlogged, private to the connection, emptied
+        at each commit and dropped with the session. They have the columns of
+        the table, but those of STAGED_COLUMNS, and none of its constraints,
+        so stage_companies takes rows without id.
+        """
+        for table in tables:
+            columns = STAGED_COLUMNS.get(table, "*")
+            self.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS stage_{table} ON COMMIT DELETE ROWS "
+                f"AS SELECT {columns} FROM {table} WITH NO DATA"
+            )
+        self.commit()
+
+    def stage_write(self, df: pd.DataFrame | pd.Series, table: str, index=True):
+        """copy_write into the staging table of ``table``"""
+        self.copy_write(df, f"stage_{table}", index=index)
+
+    def merge_staged(self, table: str):
+        """Upsert the staged rows of ``table`` on its unique key
+
+        Staged rows replace the existing rows with the same key, so that
+        writing the same data twice leaves the table unchanged. The columns
+        which are not staged take their default.
+        """
+        columns = list(self.get_table_types(f"stage_{table}"))
+        keys = MERGE_KEYS[table]
+        updates = [c for c in columns if c not in keys]
+        if updates:
+            action = "DO UPDATE SET " + ", ".join(f"{c} = EXCLUDED.{c}" for c in updates)
+        else:
+            action = "DO NOTHING"
+        columns_sql = ", ".join(columns)
+        self.execute(
+            f"INSERT INTO {table} ({columns_sql}) "
+            f"SELECT {columns_sql} FROM stage_{table} "
+            f"ON CONFLICT ({', '.join(keys)}) {action}"
+        )
+
+    def accumulate_staged_daystocks(self):
+        """Merge the staged daystocks into the days they complete
+
+        The open and close are the ones of the earliest and latest ticks, the
+        rows written without ``open_date`` and ``close_date`` being older than
+        the staged ticks. The cumulated volume moves on, high and low widen,
+        and mean and std are pooled on their tick counts ``nb``. A row without
+        ``nb`` counts for nothing.
+        """
+        n1, n2 = "coalesce(d.nb, 0)", "EXCLUDED.nb"
+        is_earlier = "EXCLUDED.open_date < d.open_date"
+        is_later = "d.close_date IS NULL OR EXCLUDED.close_date >= d.close_date"
+        mean1, std1 = "coalesce(d.mean, EXCLUDED.mean)", "coalesce(d.std, 0)"
+        columns_sql = ", ".join(self.get_table_types("daystocks"))
+        self.execute(
+            f"""INSERT INTO daystocks AS d ({columns_sql})
+            SELECT {columns_sql} FROM stage_daystocks
+            ON CONFLICT (cid, date) DO UPDATE SET
+              open = CASE WHEN {is_earlier} THEN EXCLUDED.open ELSE d.open END,
+              close = CASE WHEN {is_later} THEN EXCLUDED.close ELSE d.close END,
+              open_date = least(d.open_date, EXCLUDED.open_date),
+              close_date = greatest(d.close_date, EXCLUDED.close_date),
+              high = greatest(d.high, EXCLUDED.high),
+              low = least(d.low, EXCLUDED.low),
+              volume = greatest(d.volume, EXCLUDED.volume),
+              mean = ({n1} * {mean1} + {n2} * EXCLUDED.mean) / ({n1} + {n2}),
+              std = CASE WHEN {n1} + {n2} > 1 THEN sqrt((
+                  greatest({n1} - 1, 0) * {std1} ^ 2 + ({n2} - 1) * EXCLUDED.std ^ 2
+                  + ({mean1} - EXCLUDED.mean) ^ 2 * {n1} * {n2} / ({n1} + {n2})
+                ) / ({n1} + {n2} - 1)) ELSE 0 END,
+              nb = {n1} + {n2}"""
+        )
+
+    def register_companies(self, df_companies: pd.DataFrame) -> tuple[dict, int]:
+        """Insert the companies whose symbol is unknown, in their own transaction
+
+        Returns the id of every symbol of ``df_companies`` and the number of
+        companies inserted. Registrations are serialized by an advisory lock
+        and only insert the symbols missing from companies: a conflicting
+        insert would still draw an id from company_id_seq, and ids are
+        SMALLINT.
+        """
+        columns_sql = ", ".join(df_companies.columns)
+        self.execute("SELECT pg_advisory_xact_lock(hashtext('companies'))")
+        self.copy_write(df_companies, "stage_companies", index=False)
+        inserted = self.raw_query(
+            f"INSERT INTO companies ({columns_sql}) "
+            f"SELECT {columns_sql} FROM stage_companies s "
+            f"WHERE NOT EXISTS (SELECT 1 FROM companies c WHERE c.symbol = s.symbol) "
+            f"ORDER BY symbol ON CONFLICT (symbol) DO NOTHING RETURNING id"
+        )
+        ids = self.raw_query(
+            "SELECT c.symbol, c.id FROM companies c JOIN stage_companies s USING (symbol)"
+        )
+        self.commit()
+        if len(inserted) > 0:
+            self.refresh_search_cache()
+        return dict(ids), len(inserted)
+
+    def setup_unique_keys(self):
+        """Unique (cid, date) indexes of stocks and daystocks, for merge_staged
+
+        The older databases have non unique indexes idx_cid_<table> on these
+        columns: the duplicated rows are removed, keeping one of each key,
+        before the unique index replaces the old one.
+        """
+        for table in ("stocks", "daystocks"):
+            index = f"idx_cid_date_{table}"
+            if self.raw_query("SELECT 1 FROM pg_indexes WHERE indexname = %s", (index,)):
+                continue
+            with self.connection.cursor() as cursor:
+                # rows of the same date are in the same chunk, their ctid compare
+                cursor.execute(
+                    f"DELETE FROM {table} a USING {table} b WHERE a.cid = b.cid "
+                    "AND a.date = b.date AND a.ctid < b.ctid"
+                )
+                if cursor.rowcount > 0:
+                    print(f"Removed {cursor.rowcount} duplicated rows of {table}")
+            self.execute(f"CREATE UNIQUE INDEX {index} ON {table} (cid, date DESC)")
+            self.execute(f"DROP INDEX IF EXISTS idx_cid_{table}", commit=True)
+
+    def setup_company_search(self):
+        """Index the search columns of companies for search_companies
+
+        A trigram index over all of them with pg_trgm, else prefix indexes
+        on each of them.
+        """
+        try:
+            self.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            self.execute(
+                "CREATE INDEX IF NOT EXISTS idx_search_companies ON companies "
+                f"USING gin (({SEARCH_TEXT}) gin_trgm_ops)",
+                commit=True,
+            )
+        except psycopg2.Error as e:
+            self.connection.rollback()
+            print(f"No trigram index of the companies, prefix indexes instead: {e}")
+            for column in SEARCH_COLUMNS:
+                self.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{column}_prefix_companies "
+                    f"ON companies (lower({column}) text_pattern_ops)",
+                    commit=True,
+                )
+        self.__trigram_search = None
+
+    def quarantine_files(self, files_df: pd.DataFrame, stage: str, reasons):
+        """Record files which could not be ingested, in the current transaction
+
+        ``files_df`` is a slice of the files catalog, ``reasons`` a reason or a
+        dict of reasons by file name. A file quarantined again has one more
+        attempt.
+        """
+        if not isinstance(reasons, dict):
+            reasons = dict.fromkeys(files_df["name"], reasons)
+        df = pd.DataFrame(
+            {
+                "name": files_df["name"].to_numpy(),
+                "date": files_df.index.to_numpy(),
+                "stage": stage,
+                "reason": files_df["name"].map(reasons).astype(str).str[:1000].to_numpy(),
+            }
+        )
+        self.copy_write(df, "stage_quarantine", index=False)
+        self.execute(
+            """INSERT INTO quarantine (name, date, stage, reason, attempts, last_attempt)
+               SELECT name, date, stage, reason, 1, now() FROM stage_quarantine
+               ON CONFLICT (name) DO UPDATE SET stage = EXCLUDED.stage,
+                 reason = EXCLUDED.reason, attempts = quarantine.attempts + 1,
+                 last_attempt = now()"""
+        )
+        self.execute("TRUNCATE stage_quarantine")
+
+    def release_quarantined(self):
+        """Remove the staged file_done names from quarantine"""
+        self.execute(
+            "DELETE FROM quarantine q USING stage_file_done s WHERE q.name = s.name"
+        )
+
+    def get_retryable_files(
+        self, max_attempts: int, backoff: str, max_backoff: str
+    ) -> list[str]:
+        """Quarantined files with less than ``max_attempts`` attempts whose
+        backoff, doubled at each attempt up to ``max_backoff``, has elapsed"""
+        rows = self.raw_query(
+            """SELECT name FROM quarantine WHERE attempts < %s
+               AND last_attempt + least(%s::interval * power(2, attempts - 1),
+                                        %s::interval) <= now()""",
+            (max_attempts, backoff, max_backoff),
+        )
+        self.commit()
+        return [r[0] for r in rows]
+
     # general query methods
 
     def raw_query(self, query, args=None, cursor=None):
         """Return a tuple from a Postgres SQL query"""
         if args is None:
-            pretty = query
+            self.logger.debug("SQL: QUERY: %s", query)
         else:
-            pretty = "%s %% %r" % (query, args)
-        self.logger.debug("SQL: QUERY: %s" % pretty)
+            self.logger.debug("SQL: QUERY: %s %% %r", query, args)
         if cursor is None:
             cursor = self.connection.cursor()
         cursor.execute(query, args)
@@ -547,7 +942,7 @@ class TimescaleStockMarketModel:
         """
         if args is not None:
             query = query % args
-        self.logger.debug("df_query: %s" % query)
+        self.logger.debug("df_query: %s", query)
         return pd.read_sql(
             query,
             self.__engine,
@@ -576,6 +971,9 @@ class TimescaleStockMarketModel:
         :getmax: number of answers wanted
         :return: the id of the company if known. 0 if unknown.
 
+        With getmax=1 the name is looked for as is, then whatever its case,
+        as a prefix and as a part, stopping at the first kind of match.
+
         >>> db = TimescaleStockMarketModel('bourse', 'ricou', 'localhost', 'monmdp') # doctest: +ELLIPSIS
         Logs...
         >>> db.search_company_id("total")
@@ -585,32 +983,32 @@ class TimescaleStockMarketModel:
         >>> db.search_company_id("Should not exist !!")
         0
         """
+        pattern = "%" + escape_like(name.lower()) + "%"
         if getmax > 1:
-            res = self.raw_query(
-                "SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)",
-                ("%" + name + "%",),
-            )
+            rank = "1"
+        elif strict:
+            rank = "CASE WHEN name = %(name)s THEN 1 END"
         else:
-            res = self.raw_query("SELECT (id) FROM companies WHERE name = %s", (name,))
-            if len(res) == 0 and not strict:
-                res = self.raw_query(
-                    "SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)",
-                    (name,),
-                )
-                if len(res) == 0:
-                    res = self.raw_query(
-                        "SELECT (id) FROM companies WHERE name LIKE %s", (name + "%",)
-                    )
-                    if len(res) == 0:
-                        res = self.raw_query(
-                            "SELECT (id) FROM companies WHERE name LIKE %s",
-                            ("%" + name + "%",),
-                        )
-                        if len(res) == 0:
-                            res = self.raw_query(
-                                "SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)",
-                                ("%" + name + "%",),
-                            )
+            rank = """CASE WHEN name = %(name)s THEN 1
+                           WHEN lower(name) = lower(%(name)s) THEN 2
+                           WHEN name LIKE %(prefix)s THEN 3
+                           WHEN name LIKE %(part)s THEN 4
+                           ELSE 5 END"""
+        # the match on the search text lets the trigram index filter first
+        res = self.raw_query(
+            f"""SELECT id, rank FROM (
+                  SELECT id, {rank} AS rank FROM companies
+                  WHERE lower(name) LIKE %(pattern)s AND {SEARCH_TEXT} LIKE %(pattern)s
+                ) m WHERE rank IS NOT NULL ORDER BY rank, id LIMIT %(limit)s""",
+            {
+                "name": name,
+                "prefix": escape_like(name) + "%",
+                "part": "%" + escape_like(name) + "%",
+                "pattern": pattern,
+                "limit": max(getmax, 2),
+            },
+        )
+        res = [r for r in res if r[1] == res[0][1]]
         if len(res) == 1:
             return res[0][0]
         elif len(res) > 1 and len(res) < getmax:
@@ -618,14 +1016,204 @@ class TimescaleStockMarketModel:
         else:
             return 0
 
+    def search_companies(
+        self, query: str, k: int = 10, min_score: float = 0.0
+    ) -> list[tuple[int, str, str, float]]:
+        """Companies best matching ``query``, as (id, name, symbol, score)
+
+        Looks in the name, symbol, ticker and ISIN with a single query. With
+        pg_trgm the score is the word similarity of the query to them, else
+        the share of a column the query is a prefix of. An exact match scores
+        1. With pg_trgm and ``min_score``, the trigram matches are those above
+        ``min_score`` instead of pg_trgm.word_similarity_threshold. An empty
+        query finds nothing. Results are kept when SEARCH_CACHE_SIZE > 0, see
+        refresh_search_cache.
+        """
+        q = query.strip().lower()
+        if not q:
+            return []
+        key = (q, k, min_score)
+        if key in self.__search_cache:
+            self.__search_cache.move_to_end(key)
+            return self.__search_cache[key]
+        exact = ", ".join(f"lower({c})" for c in SEARCH_COLUMNS)
+        # own transaction, so that the caller's one is neither committed nor
+        # disturbed by SET LOCAL
+        with self.__engine.begin() as connection:
+            if self.__trigram_search is None:
+                self.__trigram_search = connection.exec_driver_sql(
+                    "SELECT EXISTS "
+                    "(SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+                ).scalar()
+            if self.__trigram_search:
+                score = f"word_similarity(%(q)s, {SEARCH_TEXT})"
+                where = f"%(q)s <%% {SEARCH_TEXT} OR {SEARCH_TEXT} LIKE %(part)s"
+                if min_score > 0:
+                    # <% keeps the scores above this threshold, 0.6 by default
+                    connection.exec_driver_sql(
+                        "SET LOCAL pg_trgm.word_similarity_threshold = %(min_score)s",
+                        {"min_score": min_score},
+                    )
+            else:
+                score = "greatest(" + ", ".join(
+                    f"CASE WHEN lower({c}) LIKE %(prefix)s "
+                    f"THEN length(%(q)s)::float / nullif(length({c}), 0) END"
+                    for c in SEARCH_COLUMNS
+                ) + ")"
+                where = " OR ".join(
+                    f"lower({c}) LIKE %(prefix)s" for c in SEARCH_COLUMNS
+                )
+            matches = connection.exec_driver_sql(
+                f"""SELECT id, name, symbol, score FROM (
+                      SELECT id, name, symbol,
+                             CASE WHEN %(q)s IN ({exact}) THEN 1
+                                  ELSE {score} END AS score
+                      FROM companies WHERE {where}
+                    ) m WHERE score >= %(min_score)s
+                    ORDER BY score DESC, length(name), id LIMIT %(k)s""",
+                {
+                    "q": q,
+                    "prefix": escape_like(q) + "%",
+                    "part": "%" + escape_like(q) + "%",
+                    "min_score": min_score,
+                    "k": k,
+                },
+            ).fetchall()
+        matches = [
+            (id, name, symbol, float(score)) for id, name, symbol, score in matches
+        ]
+        if SEARCH_CACHE_SIZE > 0:
+            self.__search_cache[key] = matches
+            if len(self.__search_cache) > SEARCH_CACHE_SIZE:
+                self.__search_cache.popitem(last=False)
+        return matches
+
+    def refresh_search_cache(self):
+        """Forget the cached searches, to call when companies change"""
+        self.__search_cache.clear()
+
     def is_file_done(self, name):
         """
         Check if a file has already been included in the DB
         """
         return self.raw_query(
-            "SELECT EXISTS ( SELECT 1 FROM file_done WHERE name = '%s' );" % name
+            "SELECT EXISTS ( SELECT 1 FROM file_done WHERE name = %s );", (name,)
         )[0][0]
 
+    def get_pending_files(self, names: pd.Series) -> list[str]:
+        """
+        Return the names which are neither in file_done nor in quarantine.
+
+        The candidate names are copied into a temporary table and anti-joined
+        with file_done in Postgres, so only the pending names come back.
+        """
+        self.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS candidate_files (name VARCHAR) "
+            "ON COMMIT DELETE ROWS"
+        )
+        self.copy_write(names.rename("name"), "candidate_files", index=False)
+        pending = self.raw_query(
+            """SELECT c.name FROM candidate_files c
+               WHERE NOT EXISTS (SELECT 1 FROM file_done f WHERE f.name = c.name)
+               AND NOT EXISTS (SELECT 1 FROM quarantine q WHERE q.name = c.name)"""
+        )
+        self.commit()
+        return [p[0] for p in pending]
+
+    def refresh_rollups(self):
+        """Materialize the rows of the continuous aggregates written since the
+        last refresh, in ROLLUPS order.
+
+        refresh_continuous_aggregate cannot run in a transaction, so the
+        pending one is committed and the refresh runs in autocommit.
+        """
+        self.commit()
+        self.connection.autocommit = True
+        try:
+            for view_name in ROLLUPS:
+                try:
+                    self.execute(
+                        "CALL refresh_continuous_aggregate(%s, NULL, NULL)",
+                        (view_name,),
+                    )
+                except psycopg2.Error as e:
+                    print(f"Error refreshing {view_name}: {e}")
+        finally:
+            self.connection.autocommit = False
+
+    def setup_stocks_storage(self, chunk_interval=STOCKS_CHUNK_INTERVAL):
+        """Switch stocks to compressed storage
+
+        New chunks span ``chunk_interval``. Compressed chunks store the rows of
+        each cid together, ordered by date, so a range scan of one company
+        decompresses only its own segments. The policy compresses the chunks
+        older than two intervals, compress_backfilled_chunks the ones an
+        ingest has completed. Also works on an existing database, the
+        compression settings are left alone once enabled since they cannot
+        change while chunks are compressed.
+        """
+        try:
+            self.execute(
+                "SELECT set_chunk_time_interval('stocks', %s::interval)",
+                (chunk_interval,),
+            )
+            compression_enabled = self.raw_query(
+                """SELECT compression_enabled FROM timescaledb_information.hypertables
+                   WHERE hypertable_name = 'stocks'"""
+            )
+            if len(compression_enabled) == 0 or not compression_enabled[0][0]:
+                self.execute(
+                    "ALTER TABLE stocks SET (timescaledb.compress, "
+                    "timescaledb.compress_segmentby = 'cid', "
+                    "timescaledb.compress_orderby = 'date DESC')"
+                )
+            self.execute(
+                "SELECT add_compression_policy('stocks', "
+                "compress_after => 2 * %s::interval, if_not_exists => true)",
+                (chunk_interval,),
+            )
+            self.commit()
+        except psycopg2.Error as e:
+            print(f"Error setting up stocks compression: {e}")
+            self.connection.rollback()
+
+    def compress_backfilled_chunks(self, chunk_interval=STOCKS_CHUNK_INTERVAL):
+        """Compress the stocks chunks older than the latest chunk interval
+
+        An ingest writes every pending file, so the chunks before the last
+        ``chunk_interval`` of data will not receive new rows. Returns the
+        number of chunks compressed.
+        """
+        try:
+            compressed = self.raw_query(
+                """SELECT compress_chunk(c, if_not_compressed => true)
+                   FROM show_chunks('stocks', older_than =>
+                     (SELECT max(date) FROM stocks) - %s::interval) c""",
+                (chunk_interval,),
+            )
+            self.commit()
+            return len(compressed)
+        except psycopg2.Error as e:
+            print(f"Error compressing stocks chunks: {e}")
+            self.connection.rollback()
+            return 0
+
+    def get_stocks_storage(self) -> dict:
+        """Return the disk size of stocks and the compression of its chunks"""
+        try:
+            row = self.raw_query(
+                """SELECT hypertable_size('stocks'),
+                     (SELECT count(*) FROM timescaledb_information.chunks
+                      WHERE hypertable_name = 'stocks'),
+                     (SELECT count(*) FROM timescaledb_information.chunks
+                      WHERE hypertable_name = 'stocks' AND is_compressed)"""
+            )[0]
+        except psycopg2.Error:
+            # plain postgres
+            self.connection.rollback()
+            row = self.raw_query("SELECT pg_total_relation_size('stocks'), 1, 0")[0]
+        return {"bytes": row[0], "chunks": row[1], "compressed_chunks": row[2]}
+
     def get_market_id_from_alias(self, alias: str):
         return self.raw_query("SELECT id FROM markets WHERE alias = %s;", (alias,))[0][
             0
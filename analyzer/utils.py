@@ -1,10 +1,12 @@
 from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
-import pandas as pd
+import numpy as np
 import pandas as pd
 import os
 import time
+from typing import Optional
 from constant import DATA_PATH, DATA_PATH_SAMY, FILES_INFO_PATH
+import metrics
 from models import FileInfo
 
 
@@ -57,11 +59,12 @@ def get_files_infos_windows_df(cache=False) -> pd.DataFrame:
         return _get_files_infos_df()
 
 
-def get_files_infos_df(cache=False) -> pd.DataFrame:
+def get_files_infos_df(cache=False, data_path: str = DATA_PATH) -> pd.DataFrame:
     def _get_files_infos_df():
         files_infos: list[FileInfo] = []
-        for root, dirs, files in os.walk(DATA_PATH):
-            if len(dirs) > 0:
+        for root, dirs, files in os.walk(data_path):
+            # leaves which are not years, such as the snapshot cache
+            if len(dirs) > 0 or not os.path.basename(root).isdigit():
                 continue
             year = int(root.split("/")[-1])
             for file in files:
@@ -165,6 +168,135 @@ def multi_read_df_from_paths(
     df["symbol"] = df["symbol"].astype(str)
     return df
 
+
+LAST_SUFFIX_PATTERN = r"\((.*?)\)"
+
+
+def parse_last_column(last: pd.Series) -> tuple[np.ndarray, pd.Categorical]:
+    """Parse the boursorama ``last`` column into float prices and suffix codes.
+
+    Values that are already numbers (or plain numeric strings) are converted in
+    one ``pd.to_numeric`` call. The remaining strings, such as ``"12.5(c)"`` or
+    ``"1 234.5"``, are factorized first so that the regex cleanup only runs once
+    per distinct value. The ``(c)``-style suffix is returned as a categorical,
+    unsuffixed prices get a missing code.
+    """
+    prices = pd.to_numeric(last, errors="coerce").to_numpy(dtype=np.float64)
+    codes = np.full(len(last), -1, dtype=np.int8)
+    categories: list[str] = []
+    todo = np.flatnonzero(np.isnan(prices) & last.notna().to_numpy())
+    if len(todo) > 0:
+        uniques_codes, uniques = pd.factorize(last.to_numpy()[todo])
+        raw = pd.Series(uniques).astype(str)
+        suffixes = pd.Categorical(raw.str.extract(LAST_SUFFIX_PATTERN, expand=False))
+        codes[todo] = suffixes.codes[uniques_codes]
+        categories = list(suffixes.categories)
+        cleaned = raw.str.replace(LAST_SUFFIX_PATTERN, "", regex=True).str.replace(
+            " ", ""
+        )
+        prices[todo] = pd.to_numeric(cleaned, errors="coerce").to_numpy()[
+            uniques_codes
+        ]
+    return prices, pd.Categorical.from_codes(codes, categories=categories)
+
+
+def snapshots_to_df(
+    frames: list[pd.DataFrame], timestamps, markets=None
+) -> pd.DataFrame:
+    """Concatenate raw snapshot DataFrames taken at ``timestamps``.
+
+    ``symbol`` and ``name`` become categoricals and ``last_suffix`` keeps the
+    ``(c)``-style suffix of ``last``. ``markets``, the market of each frame,
+    fills a ``market`` categorical. Without frames, the result is empty.
+    """
+    if len(frames) == 0:
+        frames = [pd.DataFrame({"symbol": [], "name": [], "last": [], "volume": []})]
+        frames[0]["volume"] = frames[0]["volume"].astype(np.int64)
+    lengths = np.fromiter((len(f) for f in frames), dtype=np.int64, count=len(frames))
+    df = pd.concat(frames, ignore_index=True)
+    df.index = pd.DatetimeIndex(np.repeat(np.asarray(timestamps), lengths), name="date")
+    df["last"], df["last_suffix"] = parse_last_column(df["last"])
+    df["name"] = df["name"].astype("category")
+    df["symbol"] = df["symbol"].astype("category")
+    if markets is not None:
+        codes, categories = pd.factorize(np.asarray(markets))
+        df["market"] = pd.Categorical.from_codes(np.repeat(codes, lengths), categories)
+    return df
+
+
+SNAPSHOT_COLUMNS = ["symbol", "name", "last", "volume"]
+
+
+def read_snapshot_file(path: str) -> pd.DataFrame:
+    """Unpickle a snapshot file, raising ValueError if it is not a snapshot"""
+    df = pd.read_pickle(path)
+    if not isinstance(df, pd.DataFrame):
+        raise ValueError(f"not a DataFrame but a {type(df).__name__}")
+    missing = [c for c in SNAPSHOT_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f"missing columns {', '.join(missing)}")
+    if pd.to_numeric(df["volume"], errors="coerce").isna().any():
+        raise ValueError("non numeric volume")
+    return df
+
+
+class UnreadableFilesError(ValueError):
+    """None of the files could be read, ``errors`` holds the reason of each"""
+
+    def __init__(self, errors: dict):
+        super().__init__(f"No readable snapshot file among {len(errors)}")
+        self.errors = errors
+
+
+def get_error_reasons(error: Exception):
+    """Reason of ``error`` for the quarantine, by file name if it has some"""
+    if isinstance(error, UnreadableFilesError):
+        return error.errors
+    return f"{type(error).__name__}: {error}"
+
+
+def read_files_df(
+    files_df: pd.DataFrame, num_thread: int, errors: Optional[dict] = None
+) -> pd.DataFrame:
+    """Read the snapshot files listed in ``files_df`` into one DataFrame.
+
+    ``files_df`` is a slice of ``get_files_infos_df``: the row timestamps are
+    taken from its index instead of being parsed again from the file names.
+    With an ``errors`` dict, the files are checked, the bad ones are skipped
+    and their reason is stored in ``errors`` by file name. If none of them
+    can be read, an ``UnreadableFilesError`` carries these reasons.
+    """
+    paths = list(files_df["path"])
+    if errors is None:
+        with ThreadPoolExecutor(max_workers=num_thread) as executor:
+            frames = list(executor.map(pd.read_pickle, paths))
+        with metrics.timed("parse"):
+            return snapshots_to_df(
+                frames, files_df.index.to_numpy(), files_df["market"].to_numpy()
+            )
+
+    def try_read(path):
+        try:
+            return read_snapshot_file(path)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=num_thread) as executor:
+        results = list(executor.map(try_read, paths))
+    good = np.array([not isinstance(r, Exception) for r in results], dtype=bool)
+    for name, result in zip(files_df["name"], results):
+        if isinstance(result, Exception):
+            errors[name] = f"{type(result).__name__}: {result}"
+    if not good.any():
+        raise UnreadableFilesError(errors)
+    with metrics.timed("parse"):
+        return snapshots_to_df(
+            [r for r in results if not isinstance(r, Exception)],
+            files_df.index.to_numpy()[good],
+            files_df["market"].to_numpy()[good],
+        )
+
+
 def timer_decorator(func):
     def wrapper(*args, **kwargs):
         start_time = time.time()
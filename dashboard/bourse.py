@@ -50,6 +50,28 @@ the_selected_companies = [
     4570,
 ]
 
+# chart resolutions, coarsest first: label -> (table, price column, rows per
+# trading day). The rollups are continuous aggregates of stocks and daystocks.
+RESOLUTIONS = {
+    "1 month": ("daystocks_1mo", "close", 1 / 21),
+    "1 week": ("daystocks_1w", "close", 1 / 5),
+    "1 day": ("daystocks", "close", 1),
+    "1 hour": ("stocks_1h", "close", 9),
+    "5 min": ("stocks_5m", "close", 102),
+    "1 min": ("stocks", "value", 510),
+}
+MIN_CHART_POINTS = 300
+
+
+def get_auto_resolution(start_date: str, end_date: str) -> str:
+    """Coarsest resolution giving at least MIN_CHART_POINTS over the range"""
+    days = (datetime.fromisoformat(end_date) - datetime.fromisoformat(start_date)).days
+    trading_days = max(days, 1) * 5 / 7
+    for label, (_, _, rows_per_day) in RESOLUTIONS.items():
+        if trading_days * rows_per_day >= MIN_CHART_POINTS:
+            return label
+    return "1 min"
+
 
 @app.callback(
     [
@@ -103,6 +125,17 @@ headerGraph = dbc.Row(
 )
 
 
+@app.callback(
+    Output("candle-timeframe-container", "style"),
+    [Input("chart-type", "value")],
+)
+def toggle_candle_timeframe(chart_type):
+    if chart_type == "Candle Stick":
+        return {"display": "block"}
+    else:
+        return {"display": "none"}
+
+
 @app.callback(
     Output("compared-companies-dropdown", "value"),
     [Input("compared-companies-dropdown", "value")],
@@ -251,7 +284,7 @@ def update_selected_companies_output(
 
     return dash_table.DataTable(
         id="tbl",
-        hidden_columns=["color"],
+        hidden_columns=["color", "nb", "open_date", "close_date"],
         data=merged_data.to_dict("records"),
         columns=columns,
         page_current=0,
@@ -588,6 +621,23 @@ preference_settings = html.Div(
                             ],
                             className="mt-3",
                         ),
+                        html.Div(
+                            [
+                                dbc.Label("Candle timeframe"),
+                                dcc.Dropdown(
+                                    id="candle-timeframe",
+                                    options=["Auto"]
+                                    + [r for r in RESOLUTIONS if r != "1 min"],
+                                    value="1 day",
+                                    clearable=False,
+                                    className="custom-dropdown",
+                                    style={"color": "black"},
+                                ),
+                            ],
+                            id="candle-timeframe-container",
+                            className="mt-3",
+                            style={"display": "none"},
+                        ),
                         html.Div(
                             [
                                 dbc.Label("Compare with"),
@@ -736,6 +786,7 @@ def create_volume_trace(df, label):
         Input("compared-companies-dropdown", "value"),
         Input("switch-ma", "value"),
         Input("ma-window", "value"),
+        Input("candle-timeframe", "value"),
     ],
 )
 def update_companies_chart(
@@ -750,6 +801,7 @@ def update_companies_chart(
     compared_companies_dropdown: Optional[list[int]] = None,
     ma=False,
     ma_window: Optional[int]=None,
+    candle_timeframe: str = "1 day",
 ):
 
     if volume:
@@ -795,16 +847,15 @@ def update_companies_chart(
     if not start_date or not end_date:
         return fig
     end_date = str(datetime.fromisoformat(end_date) + timedelta(days=1))
-    from_source = (
-        "daystocks"
-        if chart_type == "Candle Stick" or chart_type == "Line (Daily)"
-        else "stocks"
-    )
-    column_value = (
-        "close"
-        if chart_type == "Candle Stick" or chart_type == "Line (Daily)"
-        else "value"
-    )
+    if chart_type == "Line (Daily)":
+        resolution = "1 day"
+    elif chart_type == "Candle Stick" and candle_timeframe != "Auto":
+        resolution = candle_timeframe
+    else:
+        resolution = get_auto_resolution(start_date, end_date)
+        if chart_type == "Candle Stick" and resolution == "1 min":
+            resolution = "5 min"
+    from_source, column_value, _ = RESOLUTIONS[resolution]
     for i, value in enumerate(the_selected_companies):
         label = companies_id_to_labels.get(value, "")
 
@@ -858,8 +909,20 @@ def update_companies_chart(
     if volume:
         value = the_selected_companies[0]
         label = companies_id_to_labels.get(value, "")
+        # raw stocks have no open and close to color the bars
+        volume_source = from_source if column_value == "close" else "daystocks"
+        if volume_source.startswith("stocks_"):
+            # the rollups of stocks hold the cumulated volume of the day, so
+            # the lag runs over whole days before keeping the range
+            volume_source = (
+                "(SELECT cid, date, open, close, volume - coalesce(lag(volume) OVER "
+                "(PARTITION BY date_trunc('day', date) ORDER BY date), 0) AS volume "
+                f"FROM {volume_source} WHERE cid = {value} "
+                f"and date >= date_trunc('day', '{start_date}'::timestamp) "
+                f"and date < '{end_date}') AS day_volumes"
+            )
         df = pd.read_sql_query(
-            f"SELECT * FROM daystocks WHERE cid = {value} and date >= '{start_date}' and date < '{end_date}' ORDER by date",
+            f"SELECT date, open, close, volume FROM {volume_source} WHERE cid = {value} and date >= '{start_date}' and date < '{end_date}' ORDER by date",
             engine,
         )
         fig.add_trace(create_volume_trace(df, label), row=2, col=1)
@@ -905,7 +968,7 @@ def update_table(div_null, start_date, end_date):
 
     return dash_table.DataTable(
         id="table",
-        hidden_columns=["color"],
+        hidden_columns=["color", "nb", "open_date", "close_date"],
         data=df.to_dict("records"),
         page_current=0,
         sort_action="native",  # Enable sorting on all sortable columns